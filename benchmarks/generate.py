@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data for the scqcweb benchmarks
+
+Writes an SDS archive of SOH channels (dcz, lcq, vep, ...) and HN? data, the
+StationXML inventories SDS_ppsd.py needs, a QC store for the stations and a
+system_stats database, so the web app can be measured on a machine without
+SeisComP or network access. The same seed and sizes give the same data, with
+times relative to the current UTC day as the views expect.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core.inventory import Channel, Inventory, Network, Response, Site, Station
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_path, '..', 'listeners'))
+
+import qc_store
+import stats_db
+import system_monitor
+
+# SOH channels and the mean and spread of their values, units as in SOH_desc of scqcweb.py
+SOH_values = {'dcz': (120, 40), 'dcn': (-80, 40), 'dce': (60, 40),
+              'rmz': (300, 80), 'rmn': (280, 80), 'rme': (290, 80),
+              'mxz': (2000, 500), 'mxn': (1900, 500), 'mxe': (2100, 500),
+              'cpu': (35, 10), 'deg': (250, 30), 'dsk': (40, 2),
+              'lcq': (100, 1), 'vep': (12500, 150), 'vec': (300, 20)}
+HN_channels = ['HNZ', 'HNN', 'HNE']
+HN_location = '00'
+SOH_location = ''
+# Counts per m/s**2 of the synthetic accelerometers
+HN_gain = 4e5
+
+def station_codes(stations, network='XX'):
+    return [(network, 'S%03d' % i) for i in range(stations)]
+
+def sds_file(sds_path, net, sta, loc, cha, day):
+    return os.path.join(sds_path, str(day.year), net, sta, cha + '.D',
+                        '%s.%s.%s.%s.D.%d.%03d' % (net, sta, loc, cha, day.year, day.julday))
+
+# Write the samples of starttime to endtime as one file per UTC day
+def write_days(sds_path, net, sta, loc, cha, data, sampling_rate, starttime):
+    tr = Trace(data=data.astype(np.int32), header={'network': net, 'station': sta, 'location': loc, 'channel': cha,
+                                                   'sampling_rate': sampling_rate, 'starttime': starttime})
+    day = UTCDateTime(starttime.date)
+    while day < tr.stats.endtime:
+        part = tr.slice(day, day + 86400 - tr.stats.delta)
+        if len(part.data) > 0:
+            path = sds_file(sds_path, net, sta, loc, cha, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            Stream([part]).write(path, format='MSEED', encoding='STEIM2', reclen=512)
+        day += 86400
+
+# SOH channels for days before today and today up to now, HN? channels for the last hn_hours
+def make_sds(sds_path, stations, days, soh_rate, hn_hours, hn_rate, now, rng):
+    start = UTCDateTime(now.date) - days * 86400
+    soh_samples = int((now - start) * soh_rate)
+    hn_start = UTCDateTime(int(now.timestamp - hn_hours * 3600))
+    hn_samples = int(hn_hours * 3600 * hn_rate)
+    for net, sta in stations:
+        for cha, (mean, spread) in SOH_values.items():
+            # Slow wander plus noise, so downsampling has something to keep
+            walk = np.cumsum(rng.normal(0, spread / 20.0, soh_samples))
+            data = mean + walk - np.linspace(0, walk[-1], soh_samples) + rng.normal(0, spread, soh_samples)
+            write_days(sds_path, net, sta, SOH_location, cha, data, soh_rate, start)
+        for cha in HN_channels:
+            data = rng.normal(0, 500, hn_samples)
+            write_days(sds_path, net, sta, HN_location, cha, data, hn_rate, hn_start)
+
+# One NET_STA.xml per station with a flat acceleration response, as read by SDS_ppsd.py
+def make_staxml(staxml_path, stations, hn_rate):
+    os.makedirs(staxml_path, exist_ok=True)
+    for net, sta in stations:
+        channels = []
+        for cha in HN_channels:
+            response = Response.from_paz(zeros=[], poles=[], stage_gain=HN_gain, stage_gain_frequency=1.0,
+                                         input_units='M/S**2', output_units='COUNTS')
+            channels.append(Channel(cha, HN_location, latitude=0.0, longitude=0.0, elevation=0.0, depth=0.0,
+                                    sample_rate=hn_rate, start_date=UTCDateTime(2000, 1, 1), response=response))
+        station = Station(sta, latitude=0.0, longitude=0.0, elevation=0.0, channels=channels,
+                          site=Site(name=sta), start_date=UTCDateTime(2000, 1, 1))
+        inv = Inventory(networks=[Network(net, stations=[station])], source='scqcweb benchmarks')
+        inv.write(os.path.join(staxml_path, '%s_%s.xml' % (net, sta)), format='STATIONXML')
+
+# QC values of every station in the store of the given backend
+def make_qc_store(path, backend, stations, rng):
+    if os.path.exists(path):
+        os.unlink(path)
+    store = qc_store.open_store(backend, path)
+    sta_list = ['%s.%s' % station for station in stations]
+    store.seed(sta_list)
+    store.upsert({sta_id: qc_values(rng) for sta_id in sta_list})
+    return store
+
+def qc_values(rng):
+    return [round(float(v), 1) for v in (rng.uniform(0, 15), rng.uniform(0, 15), rng.uniform(70, 100),
+                                         rng.integers(0, 12), rng.integers(0, 12), rng.uniform(85, 100))]
+
+# system_stats samples every interval seconds over the last days, with the rollups system_monitor.py keeps
+def make_stats_db(path, days, interval, now, rng):
+    if os.path.exists(path):
+        os.unlink(path)
+    system_monitor.db_path = path
+    conn = system_monitor.setup_database()
+    try:
+        start = now.timestamp - days * 86400
+        times = np.arange(start, now.timestamp, interval)
+        load = np.abs(1 + np.cumsum(rng.normal(0, 0.05, len(times))) % 4)
+        batch = []
+        for i, t in enumerate(times):
+            batch.append({'timestamp': UTCDateTime(t).strftime(stats_db.TIME_FORMAT),
+                          'cpu_percent': float(rng.uniform(5, 60)),
+                          'memory_percent': float(rng.uniform(30, 70)),
+                          'root_disk_usage': 40 + 20 * i / len(times),
+                          'var_disk_usage': 20.0, 'data_disk_usage': 60 + 30 * i / len(times),
+                          'opt_disk_usage': 30.0, 'home_disk_usage': 10.0,
+                          'load_avg_1min': float(load[i]), 'load_avg_5min': float(load[i] * 0.9),
+                          'load_avg_15min': float(load[i] * 0.8)})
+            if len(batch) >= 10000:
+                system_monitor.insert_stats(conn, batch)
+                batch = []
+        system_monitor.insert_stats(conn, batch)
+        stats_db.rollup(conn)
+        stats_db.prune(conn)
+    finally:
+        conn.close()
+
+# Generate everything into workspace, returns the manifest also written to workspace/manifest.json
+def generate(workspace, stations=10, days=7, stats_days=30, stats_interval=10, soh_rate=0.1,
+             hn_hours=26, hn_rate=20.0, qc_backend='sqlite', seed=1):
+    now = UTCDateTime()
+    rng = np.random.default_rng(seed)
+    codes = station_codes(stations)
+    paths = {'sds': os.path.join(workspace, 'sds'),
+             'staxml': os.path.join(workspace, 'staxml'),
+             'qc': os.path.join(workspace, 'QC_store.db' if qc_backend == 'sqlite' else 'QC_dictionary.pkl'),
+             'stats': os.path.join(workspace, 'system_monitor.db')}
+    # Start from an empty archive, so files of a larger earlier run do not remain
+    for folder in [paths['sds'], paths['staxml']]:
+        shutil.rmtree(folder, ignore_errors=True)
+    make_sds(paths['sds'], codes, days, soh_rate, hn_hours, hn_rate, now, rng)
+    make_staxml(paths['staxml'], codes, hn_rate)
+    make_qc_store(paths['qc'], qc_backend, codes, rng)
+    make_stats_db(paths['stats'], stats_days, stats_interval, now, rng)
+    manifest = {'params': {'stations': stations, 'days': days, 'stats_days': stats_days, 'stats_interval': stats_interval,
+                           'soh_rate': soh_rate, 'hn_hours': hn_hours, 'hn_rate': hn_rate,
+                           'qc_backend': qc_backend, 'seed': seed},
+                'generated': str(now),
+                'day': now.strftime('%Y-%m-%d'),
+                'stations': ['%s.%s' % code for code in codes],
+                'paths': paths}
+    with open(os.path.join(workspace, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def add_arguments(parser):
+    parser.add_argument('--workspace', default=os.path.join(bench_path, 'workspace'), help='folder for the synthetic data (default benchmarks/workspace)')
+    parser.add_argument('--stations', type=int, default=10, help='number of stations (default 10)')
+    parser.add_argument('--days', type=int, default=7, help='days of SOH data before today (default 7)')
+    parser.add_argument('--stats-days', type=int, default=30, help='days of system_stats samples (default 30)')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between system_stats samples (default 10)')
+    parser.add_argument('--soh-rate', type=float, default=0.1, help='SOH sampling rate in Hz (default 0.1)')
+    parser.add_argument('--hn-hours', type=float, default=26, help='hours of HN? data up to now (default 26)')
+    parser.add_argument('--hn-rate', type=float, default=20.0, help='HN? sampling rate in Hz (default 20)')
+    parser.add_argument('--qc-backend', choices=['sqlite', 'pickle'], default='sqlite', help='QC store backend (default sqlite)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default 1)')
+
+def generate_args(args):
+    os.makedirs(args.workspace, exist_ok=True)
+    return generate(args.workspace, stations=args.stations, days=args.days, stats_days=args.stats_days,
+                    stats_interval=args.stats_interval, soh_rate=args.soh_rate, hn_hours=args.hn_hours,
+                    hn_rate=args.hn_rate, qc_backend=args.qc_backend, seed=args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic data for the scqcweb benchmarks.')
+    add_arguments(parser)
+    args = parser.parse_args()
+    manifest = generate_args(args)
+    print("Generated %d stations in %s" % (len(manifest['stations']), args.workspace))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the scqcweb routes on synthetic data
+
+Generates (or reuses) the data of generate.py, points the web app at it with a
+config file of its own and times the routes through the Flask test client:
+the network page, SOH plots and data, helicorder and server plots, the station
+lists of the forms and a run of SDS_ppsd.py. Every run starts with empty plot
+caches, so the first request of each case is the cold time and the repeats
+are the warm times. Results are written as JSON, and compared with an earlier
+result file with --baseline to catch regressions.
+"""
+
+import argparse
+import configparser
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+repo_path = os.path.normpath(os.path.join(bench_path, '..'))
+
+import generate
+
+# Write the config file of a run, based on the repository's config.ini
+def write_config(manifest, run_dir):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(repo_path, 'config.ini'))
+    paths = manifest['paths']
+    settings = {'Flask': {'SESSION_FILE_DIR': os.path.join(run_dir, 'flask_session')},
+                'Source': {'source_ini': 'SDS'},
+                'Paths': {'path_SDS': paths['sds'],
+                          'path_system_monitor': paths['stats'],
+                          'path_ppsd_catalog': os.path.join(run_dir, 'ppsd_catalog.db')},
+                'Listener': {'qc_store': manifest['params']['qc_backend'], 'qc_path': paths['qc']},
+                'Cache': {'soh_cache_dir': os.path.join(run_dir, 'soh_cache'),
+                          'heli_cache_dir': os.path.join(run_dir, 'heli_cache'),
+                          'waveform_shm_dir': ''},
+                'Metrics': {'metrics_dir': ''}}
+    for section, values in settings.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for key, value in values.items():
+            config.set(section, key, value)
+    config_path = os.path.join(run_dir, 'config.ini')
+    with open(config_path, 'w') as f:
+        config.write(f)
+    return config_path
+
+# Progress goes to stderr, so the results can be read from stdout
+def log(message):
+    print(message, file=sys.stderr)
+
+# Summary of a list of durations in seconds
+def summary(times):
+    if not times:
+        return {}
+    ordered = sorted(times)
+    return {'min': ordered[0],
+            'median': statistics.median(ordered),
+            'mean': statistics.mean(ordered),
+            'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+            'max': ordered[-1]}
+
+class Bench:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    # Time fn once cold and repeat times warm, before() runs untimed before every call
+    # fn returns a Flask test response or None
+    def case(self, name, fn, before=None, repeat=None):
+        times = []
+        status = None
+        size = None
+        for i in range(1 + (self.repeat if repeat is None else repeat)):
+            if before is not None:
+                before()
+            start = time.perf_counter()
+            response = fn()
+            if response is not None:
+                data = response.get_data()
+            times.append(time.perf_counter() - start)
+            if response is not None:
+                status = response.status_code
+                size = len(data)
+        result = {'name': name, 'cold': times[0], 'runs': len(times) - 1, 'status': status, 'bytes': size}
+        result.update(summary(times[1:]))
+        self.results.append(result)
+        log("%-24s cold %8.1f ms  warm median %8s ms  status %s" % (name, times[0] * 1000,
+            '%.1f' % (result['median'] * 1000) if 'median' in result else '-', status))
+        return result
+
+def run(manifest, run_dir, repeat, ppsd_workers, skip_ppsd):
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    os.environ['SCQCWEB_CONFIG'] = write_config(manifest, run_dir)
+    sys.path.insert(0, repo_path)
+    # Relative folders of the web app (e.g. static) resolve against the repository
+    os.chdir(repo_path)
+    bench = Bench(repeat)
+    start = time.perf_counter()
+    import scqcweb
+    import_seconds = time.perf_counter() - start
+    bench.results.append({'name': 'import_scqcweb', 'cold': import_seconds, 'runs': 0})
+    log("%-24s cold %8.1f ms" % ('import_scqcweb', import_seconds * 1000))
+    scqcweb.app.config['TESTING'] = True
+    scqcweb.app.config['WTF_CSRF_ENABLED'] = False
+    client = scqcweb.app.test_client()
+    sta = manifest['stations'][0]
+    now = time.gmtime()
+    today = time.strftime('%Y-%m-%d', now)
+
+    # Station lists of the forms
+    bench.case('station_list_build', lambda: scqcweb.inventory.build())
+    bench.case('station_choices', lambda: scqcweb.inventory.station_choices())
+
+    # Network page: cached table, table after a QC update, and a browser holding the current page
+    bench.case('index', lambda: client.get('/'))
+    rng = np.random.default_rng(0)
+    bench.case('index_changed', lambda: client.get('/'),
+               before=lambda: scqcweb.QC.upsert({sta: generate.qc_values(rng)}))
+    etag = client.get('/').headers.get('ETag')
+    bench.case('index_not_modified', lambda: client.get('/', headers={'If-None-Match': etag}))
+
+    # Station page selects the station of the single SOH plots
+    days = manifest['params']['days']
+    client.post('/station', data={'station': sta, 'sta_days': str(days)})
+    bench.case('plot_soh', lambda: client.get('/plot/soh/lcq'))
+    etag = client.get('/plot/soh/lcq').headers.get('ETag')
+    bench.case('plot_soh_not_modified', lambda: client.get('/plot/soh/lcq', headers={'If-None-Match': etag}))
+    bench.case('plot_soh_all', lambda: client.get('/plot/soh_all?sta=%s&days=%d' % (sta, days)))
+    bench.case('api_soh_json', lambda: client.get('/api/soh/%s?days=%d&format=json' % (sta, days)))
+    bench.case('api_soh_bin', lambda: client.get('/api/soh/%s?days=%d&format=bin' % (sta, days)))
+
+    # Helicorder of the last hours of the first HN channel
+    heli_channel = '%s.%s.%s' % (sta, generate.HN_location, generate.HN_channels[0])
+    heli_start = time.gmtime(time.time() - 6 * 3600)
+    client.post('/heli', data={'heli_channel': heli_channel,
+                               'sdate': time.strftime('%Y-%m-%d', heli_start), 'stime': time.strftime('%H:%M', heli_start),
+                               'edate': today, 'etime': time.strftime('%H:%M', now)})
+    bench.case('plot_heli', lambda: client.get('/plot/heli'))
+
+    # Server plot of the whole system_stats period
+    stats_start = time.strftime('%Y-%m-%d', time.gmtime(time.time() - manifest['params']['stats_days'] * 86400))
+    client.post('/server', data={'sdate2': stats_start, 'edate2': today})
+    bench.case('plot_server', lambda: client.get('/plot/server'))
+
+    if not skip_ppsd:
+        sys.path.insert(0, os.path.join(repo_path, 'listeners'))
+        import SDS_ppsd
+        sys.argv = ['SDS_ppsd.py', '--days', '1', '--periods', '7', '--workers', str(ppsd_workers),
+                    '--sds', manifest['paths']['sds'], '--staxml', manifest['paths']['staxml'],
+                    '--ppsd-dir', os.path.join(run_dir, 'ppsd'), '--cache-dir', os.path.join(run_dir, 'ppsd', 'inventory_cache'),
+                    '--link-dir', os.path.join(run_dir, 'ppsd_links'), '--catalog', os.path.join(run_dir, 'ppsd_catalog.db')]
+        # SDS_ppsd.py writes its log to the working folder and its progress to stdout
+        os.chdir(run_dir)
+        with contextlib.redirect_stdout(sys.stderr):
+            # The second run only has the data recorded since the first one to add
+            bench.case('sds_ppsd', SDS_ppsd.main, repeat=1)
+        os.chdir(repo_path)
+    return bench.results
+
+# Cases whose median (or cold time if they have no repeats) grew by more than tolerance over the baseline
+def regressions(results, baseline, tolerance):
+    previous = {result['name']: result for result in baseline['results']}
+    slower = []
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        key = 'median' if 'median' in result and 'median' in old else 'cold'
+        if old[key] > 0 and result[key] > old[key] * (1 + tolerance):
+            slower.append({'name': result['name'], 'measure': key, 'baseline': old[key], 'value': result[key]})
+    return slower
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_path, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the scqcweb routes on synthetic data.')
+    generate.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=10, help='warm runs per case after the cold run (default 10)')
+    parser.add_argument('--regenerate', action='store_true', help='generate the data again even if the workspace matches')
+    parser.add_argument('--skip-ppsd', action='store_true', help='do not time SDS_ppsd.py')
+    parser.add_argument('--ppsd-workers', type=int, default=os.cpu_count(), help='worker processes of SDS_ppsd.py (default one per CPU)')
+    parser.add_argument('--output', help='write the results to this JSON file (default stdout)')
+    parser.add_argument('--baseline', help='earlier results file to compare with, exits with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown over the baseline (default 0.2 for 20%%)')
+    args = parser.parse_args()
+    args.workspace = os.path.abspath(args.workspace)
+
+    # Reuse the data of an earlier run with the same sizes and seed, generated on the current UTC day
+    manifest = None
+    manifest_path = os.path.join(args.workspace, 'manifest.json')
+    if not args.regenerate and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        params = {key: getattr(args, key) for key in manifest['params']}
+        if manifest['params'] != params or manifest['day'] != time.strftime('%Y-%m-%d', time.gmtime()):
+            manifest = None
+    if manifest is None:
+        start = time.perf_counter()
+        manifest = generate.generate_args(args)
+        log("Generated synthetic data in %.1f s" % (time.perf_counter() - start))
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    results = run(manifest, os.path.join(args.workspace, 'run'), args.repeat, args.ppsd_workers, args.skip_ppsd)
+    report = {'commit': git_commit(),
+              'generated': manifest['generated'],
+              'started': started,
+              'finished': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': os.cpu_count(),
+              'params': manifest['params'],
+              'repeat': args.repeat,
+              'results': results}
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = regressions(results, json.load(f), args.tolerance)
+        for slower in report['regressions']:
+            log("Regression: %s %s %.1f ms -> %.1f ms" % (slower['name'], slower['measure'],
+                                                        slower['baseline'] * 1000, slower['value'] * 1000))
+        status = 1 if report['regressions'] else 0
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Reduce time series to what can be seen at the output pixel width before plotting
+
+Uses min/max envelope (M4) aggregation: the samples are split into one bin per
+pixel column and only the first, last, minimum and maximum sample of each bin
+are kept. The drawn line is the same as with all samples, so spikes stay
+visible, while matplotlib only ever gets about four points per pixel.
+
+Scatter plots draw every point rather than a line, so for them the plot area
+is split into pixel cells instead and one point is kept per occupied cell.
+The drawn point cloud is the same, with at most one point per pixel.
+"""
+
+import numpy as np
+
+# Indices of the first, last, minimum and maximum sample in each of n_bins equal-width bins of x
+# x must be sorted
+def envelope_indices(x, y, n_bins):
+    n = len(x)
+    if n <= 4 * n_bins:
+        return np.arange(n)
+    x0 = x[0]
+    x1 = x[-1]
+    if x1 <= x0:
+        return np.arange(n)
+    edges = np.linspace(x0, x1, n_bins + 1)[1:-1]
+    starts = np.concatenate(([0], np.searchsorted(x, edges, side='left')))
+    starts = np.unique(starts)
+    starts = starts[starts < n]
+    ends = np.append(starts[1:], n) - 1
+    counts = ends - starts + 1
+    # NaN samples never win the min/max comparison
+    y_min = np.where(np.isnan(y), np.inf, y) if y.dtype.kind == 'f' else y
+    y_max = np.where(np.isnan(y), -np.inf, y) if y.dtype.kind == 'f' else y
+    mins = np.minimum.reduceat(y_min, starts)
+    maxs = np.maximum.reduceat(y_max, starts)
+    bin_of = np.repeat(np.arange(len(starts)), counts)
+    idx_min = first_per_bin(np.flatnonzero(y_min == np.repeat(mins, counts)), bin_of)
+    idx_max = first_per_bin(np.flatnonzero(y_max == np.repeat(maxs, counts)), bin_of)
+    return np.unique(np.concatenate((starts, ends, idx_min, idx_max)))
+
+# First position of each bin, positions must be sorted
+def first_per_bin(positions, bin_of):
+    bins = bin_of[positions]
+    keep = np.concatenate(([True], np.diff(bins) != 0))
+    return positions[keep]
+
+# Downsample one series to n_bins pixel columns, returns the reduced x and y arrays
+def downsample(x, y, n_bins):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= 4 * n_bins:
+        return x, y
+    if np.any(x[1:] < x[:-1]):
+        order = np.argsort(x, kind='stable')
+        x = x[order]
+        y = y[order]
+    idx = envelope_indices(x, y, n_bins)
+    return x[idx], y[idx]
+
+# Indices of one sample per occupied cell of a grid of n_cols x n_rows cells over the range of x and y
+# Samples with a NaN value are dropped
+def scatter_indices(x, y, n_cols, n_rows):
+    finite = np.flatnonzero(~np.isnan(y)) if y.dtype.kind == 'f' else np.arange(len(y))
+    if len(finite) == 0:
+        return finite
+    x = x[finite].astype(np.float64)
+    y = y[finite].astype(np.float64)
+    cols = grid_positions(x, n_cols)
+    rows = grid_positions(y, n_rows)
+    cells, first = np.unique(cols * n_rows + rows, return_index=True)
+    return np.sort(finite[first])
+
+# Cell of each value in n equal-width cells over the range of the values
+def grid_positions(values, n):
+    low = values.min()
+    high = values.max()
+    if high <= low:
+        return np.zeros(len(values), dtype=np.int64)
+    return np.minimum(((values - low) * (n / (high - low))).astype(np.int64), n - 1)
+
+# Downsample one series drawn as a scatter plot of n_cols x n_rows pixels, returns the reduced x and y arrays
+def downsample_scatter(x, y, n_cols, n_rows):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) <= 4 * n_cols:
+        return x, y
+    idx = scatter_indices(x, y, n_cols, n_rows)
+    return x[idx], y[idx]
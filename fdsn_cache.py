@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Read-through local cache for the FDSNWS waveform source
+
+Waveforms fetched from the FDSN web service are stored on local disk in SDS
+layout and read back with the SDS client. A small SQLite table records which
+span of each requested channel and UTC day has been fetched, so later requests
+only fetch the spans that are not cached yet. The spans of the channels of a
+multi-channel request are fetched in parallel, each thread keeping its own FDSN
+client so the service discovery is done once per thread. obspy's FDSN client
+opens a new HTTP connection for every request, so connections are not reused.
+"""
+
+import fcntl
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from obspy import Stream, UTCDateTime, read
+from obspy.clients.fdsn import Client as FDSNClient
+from obspy.clients.fdsn.header import FDSNNoDataException
+from obspy.clients.filesystem.sds import Client as SDSClient
+
+class CachedFDSNClient:
+    # latency: seconds data may arrive late, spans ending closer than this to the fetch time are fetched again
+    # refresh: seconds before the newest span of a day is fetched again
+    # network, station: networks and stations (comma separated, wildcards allowed) of the station metadata requests
+    def __init__(self, base_url, cache_dir, workers=8, latency=120, refresh=10, keep_days=60, network='*', station='*', **kwargs):
+        self.base_url = base_url
+        self.network = network
+        self.station = station
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.latency = latency
+        self.refresh = refresh
+        self.keep_days = keep_days
+        self.client_kwargs = kwargs
+        os.makedirs(cache_dir, exist_ok=True)
+        self.sds = SDSClient(cache_dir)
+        self.local = threading.local()
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
+        self.last_prune = 0
+        conn = self.connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS fetched (
+                    net TEXT, sta TEXT, loc TEXT, cha TEXT, day TEXT,
+                    fetched_start REAL,
+                    fetched_end REAL,
+                    fetched_at REAL,
+                    PRIMARY KEY (net, sta, loc, cha, day)
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(os.path.join(self.cache_dir, 'fetched.db'), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # FDSN client of the calling thread
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = FDSNClient(self.base_url, **self.client_kwargs)
+            self.local.client = client
+        return client
+
+    # Thread pool of this process, created again after a fork
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def fetched(self, conn, key, day):
+        return conn.execute("SELECT fetched_start, fetched_end, fetched_at FROM fetched WHERE net = ? AND sta = ? AND loc = ? AND cha = ? AND day = ?",
+                            key + (day.strftime('%Y-%m-%d'),)).fetchone()
+
+    # Spans of one requested channel (wildcards allowed) between starttime and endtime that are not cached
+    # Returns a list of (day, start, end) with start and end as timestamps
+    def missing(self, conn, key, starttime, endtime):
+        now = time.time()
+        spans = []
+        day = UTCDateTime(starttime.date)
+        while day < endtime:
+            start = max(starttime, day).timestamp
+            end = min(endtime.timestamp, day.timestamp + 86400, now)
+            row = self.fetched(conn, key, day)
+            if end > start:
+                if row is None:
+                    spans.append((day, start, end))
+                else:
+                    fetched_start, fetched_end, fetched_at = row
+                    if start < fetched_start:
+                        spans.append((day, start, fetched_start))
+                    # The newest data of a day is fetched again at most every refresh seconds, data after
+                    # a recorded end that was already settled when it was fetched is fetched right away
+                    # Only one span is recorded per day, so a request starting after the recorded end is
+                    # fetched from that end and the recorded span never covers data that was not fetched
+                    if end > fetched_end and (fetched_end < fetched_at - self.latency or now - fetched_at >= self.refresh):
+                        spans.append((day, fetched_end, end))
+            day += 86400
+        return spans
+
+    # Fetch one span from the web service and store it
+    # Returns the end time of the data of each channel
+    def fetch(self, key, start, end):
+        net, sta, loc, cha = key
+        try:
+            st = self.client().get_waveforms(net, sta, loc, cha, UTCDateTime(start), UTCDateTime(end))
+        except FDSNNoDataException:
+            return {}
+        self.store(st)
+        ends = {}
+        for tr in st:
+            ends[tr.id] = max(ends.get(tr.id, 0), tr.stats.endtime.timestamp)
+        return ends
+
+    # Add traces to the day files of the cache
+    # Data following the end of a file is appended, other data is merged with the file's data and the file rewritten
+    def store(self, st):
+        pieces = {}
+        for tr in st:
+            day = UTCDateTime(tr.stats.starttime.date)
+            while day < tr.stats.endtime:
+                piece = tr.slice(day, day + 86400 - tr.stats.delta / 2.0, nearest_sample=False)
+                if piece.stats.npts > 0:
+                    path = self.sds._get_filename(tr.stats.network, tr.stats.station, tr.stats.location, tr.stats.channel, day)
+                    pieces.setdefault(path, Stream()).append(piece)
+                day += 86400
+        for path, new in pieces.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Threads and workers storing the same station wait for each other
+            with open(os.path.join(os.path.dirname(path), '.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if os.path.exists(path):
+                        file_end = max(tr.stats.endtime for tr in read(path, headonly=True))
+                        if min(tr.stats.starttime for tr in new) > file_end - 1.5 * new[0].stats.delta:
+                            new.merge(method=1)
+                            new.trim(starttime=file_end + new[0].stats.delta / 2.0, nearest_sample=False)
+                            new = new.split()
+                            new.traces = [tr for tr in new if tr.stats.npts > 0]
+                            if len(new) > 0:
+                                output = io.BytesIO()
+                                new.write(output, format='MSEED')
+                                with open(path, 'ab') as f:
+                                    f.write(output.getvalue())
+                            continue
+                        new = read(path) + new
+                    new.merge(method=1)
+                    fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=os.path.dirname(path))
+                    os.close(fd)
+                    try:
+                        new.split().write(tmp_path, format='MSEED')
+                        os.replace(tmp_path, path)
+                    except:
+                        os.unlink(tmp_path)
+                        raise
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Record fetched spans, each span touches the span already recorded for its day
+    # The newest span of a day is recorded up to the end of its data, or up to latency seconds before now if that is later,
+    # so data still arriving is fetched again on the next request
+    def record(self, conn, key, spans, ends):
+        now = time.time()
+        with conn:
+            for day, start, end in spans:
+                settled = min(end, now - self.latency)
+                data_ends = [min(data_end, end) for data_end in ends.values() if data_end > start]
+                if data_ends:
+                    end = max(min(data_ends), settled)
+                else:
+                    end = max(start, settled)
+                row = self.fetched(conn, key, day)
+                if row is not None:
+                    start = min(row[0], start)
+                    end = max(row[1], end)
+                conn.execute("INSERT OR REPLACE INTO fetched (net, sta, loc, cha, day, fetched_start, fetched_end, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             key + (day.strftime('%Y-%m-%d'), start, end, now))
+
+    # Fetch the spans of the requested channels that are not cached yet, channel may be a comma separated list
+    # Returns the requested channels as (network, station, location, channel) keys
+    def update(self, network, station, location, channel, starttime, endtime):
+        keys = [(network, station, location, cha.strip()) for cha in channel.split(',')]
+        conn = self.connect()
+        try:
+            jobs = []
+            for key in keys:
+                spans = self.missing(conn, key, starttime, endtime)
+                # Fetch spans that follow each other with one request
+                runs = []
+                for span in spans:
+                    if runs and runs[-1][-1][2] == span[1]:
+                        runs[-1].append(span)
+                    else:
+                        runs.append([span])
+                for run in runs:
+                    jobs.append((key, run, self.get_pool().submit(self.fetch, key, run[0][1], run[-1][2])))
+            for key, run, job in jobs:
+                self.record(conn, key, run, job.result())
+        finally:
+            conn.close()
+        self.prune()
+        return keys
+
+    # Same arguments as the FDSN and SDS clients, channel may be a comma separated list
+    def get_waveforms(self, network, station, location, channel, starttime, endtime):
+        st = Stream()
+        for key in self.update(network, station, location, channel, starttime, endtime):
+            st += self.sds.get_waveforms(key[0], key[1], key[2], key[3], starttime, endtime)
+        return st
+
+    # Remove cached days older than keep_days, at most once an hour
+    def prune(self):
+        if time.time() - self.last_prune < 3600:
+            return
+        self.last_prune = time.time()
+        cutoff = UTCDateTime(UTCDateTime.now().date) - self.keep_days * 86400
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT DISTINCT net, sta, day FROM fetched WHERE day < ?", (cutoff.strftime('%Y-%m-%d'),)).fetchall()
+            for net, sta, day in rows:
+                day = UTCDateTime(day)
+                station_dir = os.path.join(self.cache_dir, str(day.year), net, sta)
+                suffix = '.%04d.%03d' % (day.year, day.julday)
+                for root, dirs, files in os.walk(station_dir):
+                    for name in files:
+                        if name.endswith(suffix):
+                            os.unlink(os.path.join(root, name))
+            with conn:
+                conn.execute("DELETE FROM fetched WHERE day < ?", (cutoff.strftime('%Y-%m-%d'),))
+        finally:
+            conn.close()
+
+    # Station metadata is not cached, it is only read when the inventory index is rebuilt
+    # Requests are limited to the configured networks and stations, so a federated service
+    # does not send the inventory of every network it serves
+    def get_stations(self, **kwargs):
+        kwargs.setdefault('network', self.network)
+        kwargs.setdefault('station', self.station)
+        return self.client().get_stations(**kwargs)
+
+    # Same as the SDS client, listing what the web service has at time datetime (default now)
+    def get_all_nslc(self, datetime=None):
+        if datetime is None:
+            datetime = UTCDateTime.now()
+        inv = self.get_stations(level='channel', starttime=datetime, endtime=datetime)
+        return sorted(set((net.code, sta.code, cha.location_code, cha.code) for net in inv for sta in net for cha in sta))
+
+    def get_all_stations(self):
+        inv = self.get_stations(level='station')
+        return sorted(set((net.code, sta.code) for net in inv for sta in net))
@@ -1,9 +1,28 @@
 import os
 
-#workers = int(os.environ.get('GUNICORN_PROCESSES', '4'))
-#threads = int(os.environ.get('GUNICORN_THREADS', '4'))
-# timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+workers = int(os.environ.get('GUNICORN_PROCESSES', '4'))
+# Each open network page holds a thread for its live update stream, so use threaded workers
+# Streams are capped per worker (qc_stream_max in config.ini), leaving the other threads for requests
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '32'))
+# Plots are rendered in a separate process pool with its own timeout (render_timeout in config.ini)
+# A plot may wait render_timeout for a render process and run render_timeout, keep this longer than both
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '150'))
 bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+# Load the app once in the master and fork it into the workers, which then start in milliseconds
+# and share the loaded modules copy-on-write. Code changes need a restart instead of a HUP reload.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
 
 forwarded_allow_ips = '*'
-secure_scheme_headers = { 'X-Forwarded-Proto': 'https' }
\ No newline at end of file
+secure_scheme_headers = { 'X-Forwarded-Proto': 'https' }
+
+# Runs in the master before the first workers are forked
+def when_ready(server):
+    if preload_app:
+        import scqcweb
+        scqcweb.preload()
+
+# Report the start-up steps of each worker, for preloaded workers these are the master's
+def post_worker_init(worker):
+    import scqcweb
+    scqcweb.print_startup()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Helicorder plots built from cached one-hour tiles
+
+Each tile holds the minimum and maximum of one channel for every pixel column
+of one hour row, which is all a dayplot draws. Tiles of complete hours are kept
+in a PlotCache, so a request only reads the archive for hours that are not
+cached yet (and for the current, still growing hour). Tiles of closed UTC
+days are keyed by the version (modification time and size) of the day files,
+so data arriving late, e.g. SeedLink backfill, gives new tiles, and are cached
+with or without gaps. The day file of the open day changes all the time, so its
+tiles are keyed by the hour alone and cached once the hour is older than
+HELI_latency.
+"""
+
+import io
+
+import numpy as np
+
+from obspy import UTCDateTime
+
+# Pixel columns per hour row, same as the obspy dayplot default
+HELI_width = 800
+# Data range (counts) that fills one row, same as vertical_scaling_range of the old dayplot
+HELI_scale = 5e3
+# Row colors, same as the obspy dayplot default
+HELI_colors = ('#B2000F', '#004C12', '#847200', '#0E01FF')
+# Hours ending less than this many seconds ago are not cached because data may still arrive
+HELI_latency = 600
+
+# Start times of the hour rows covering starttime to endtime
+def heli_hours(starttime, endtime):
+    first = UTCDateTime(starttime.year, starttime.month, starttime.day, starttime.hour)
+    hours = []
+    t = first
+    while t < endtime:
+        hours.append(t)
+        t += 3600
+    return hours
+
+# Minimum and maximum per pixel column of one hour, NaN where there is no data
+def hour_tile(st, hour):
+    tile = np.full((HELI_width, 2), np.nan, dtype=np.float32)
+    for tr in st:
+        times = tr.times("timestamp") - hour.timestamp
+        keep = (times >= 0) & (times < 3600)
+        if not np.any(keep):
+            continue
+        data = tr.data[keep].astype(np.float64) * tr.stats.calib
+        pixels = (times[keep] * (HELI_width / 3600.0)).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(pixels)) + 1))
+        cols = pixels[starts]
+        mins = np.minimum.reduceat(data, starts)
+        maxs = np.maximum.reduceat(data, starts)
+        tile[cols, 0] = np.fmin(tile[cols, 0], mins)
+        tile[cols, 1] = np.fmax(tile[cols, 1], maxs)
+    return tile
+
+# Key of a tile, version is None for hours of the open day
+def tile_key(nslc, hour, version):
+    if version is None:
+        return 'heli/%s/%s' % (nslc, hour.strftime('%Y%m%dT%H'))
+    return 'heli/%s/%s/%s' % (nslc, hour.strftime('%Y%m%dT%H'), version)
+
+# Version of the archive files of the UTC day of each hour, read once per day
+# Days ending after complete_before are still being written and get None
+def hour_versions(client, nslc, hours, complete_before):
+    net, sta, loc, cha = nslc.split('.')
+    days = {}
+    versions = []
+    for hour in hours:
+        day = UTCDateTime(hour.date)
+        if day not in days:
+            days[day] = client.version(net, sta, loc, cha, day, day + 86400)[0] if day + 86400 <= complete_before else None
+        versions.append(days[day])
+    return versions
+
+# Return the tiles of every hour row, reading the archive only for hours that are not cached
+# Consecutive missing hours are read with one archive request
+# client is a WaveformCache, whose version() gives the version of the day files
+def heli_tiles(client, cache, nslc, starttime, endtime):
+    hours = heli_hours(starttime, endtime)
+    complete_before = UTCDateTime.now() - HELI_latency
+    versions = hour_versions(client, nslc, hours, complete_before)
+    keys = [tile_key(nslc, hour, version) for hour, version in zip(hours, versions)]
+    cached = cache.get_many(keys)
+    tiles = [None] * len(hours)
+    for i, key in enumerate(keys):
+        if key in cached:
+            tiles[i] = np.load(io.BytesIO(cached[key]))
+    # Group rows without a cached tile into runs of consecutive hours
+    runs = []
+    for i, tile in enumerate(tiles):
+        if tile is not None:
+            continue
+        if runs and runs[-1][-1] == i - 1:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+    net, sta, loc, cha = nslc.split('.')
+    new_tiles = {}
+    for run in runs:
+        st = client.get_waveforms(net, sta, loc, cha, hours[run[0]], hours[run[-1]] + 3600)
+        for i in run:
+            tiles[i] = hour_tile(st, hours[i])
+            # Tiles of closed days are kept with their gaps, as late data changes their key
+            # Empty hours of the open day are not kept, their data may not have arrived yet
+            if versions[i] is not None or (hours[i] + 3600 <= complete_before and not np.all(np.isnan(tiles[i]))):
+                output = io.BytesIO()
+                np.save(output, tiles[i])
+                new_tiles[keys[i]] = output.getvalue()
+    cache.put_many(new_tiles)
+    return list(zip(hours, tiles))
+
+# Draw the helicorder, one row per hour with the newest hour at the bottom
+def draw_heli(nslc, tiles):
+    # Only the render processes draw, so web workers never import matplotlib
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(8, 6), dpi=100)
+    ax = fig.add_subplot(1, 1, 1)
+    fig.subplots_adjust(left=0.12, right=0.95, top=0.95, bottom=0.1)
+    rows = len(tiles)
+    x_values = np.repeat(np.arange(HELI_width), 2)
+    for i, (hour, tile) in enumerate(tiles):
+        if np.all(np.isnan(tile)):
+            continue
+        row_center = rows - i - 0.5
+        lower = tile[:, 0] / HELI_scale
+        upper = tile[:, 1] / HELI_scale
+        waveform_center = np.nanmean((lower + upper) / 2.0)
+        y_values = np.empty(HELI_width * 2)
+        y_values[0::2] = row_center + lower - waveform_center
+        y_values[1::2] = row_center + upper - waveform_center
+        ax.plot(x_values, y_values, color=HELI_colors[i % len(HELI_colors)], linewidth=1)
+    ax.set_xlim(0, HELI_width - 1)
+    ax.set_ylim(-0.3, rows + 0.3)
+    ax.set_xticks(np.linspace(0, HELI_width - 1, 5))
+    ax.set_xticklabels(['0', '15', '30', '45', '60'])
+    ax.set_xlabel('time in minutes')
+    ax.set_yticks(np.arange(rows, 0, -1) - 0.5)
+    # Label the first row and every midnight row with the date, as rows may span several days
+    labels = []
+    for i, (hour, tile) in enumerate(tiles):
+        if i == 0 or hour.hour == 0:
+            labels.append(hour.strftime('%m-%d %H:%M'))
+        else:
+            labels.append(hour.strftime('%H:%M'))
+    ax.set_yticklabels(labels)
+    ax.grid(color='black', linestyle=':', linewidth=0.5)
+    ax.yaxis.grid(False)
+    fig.suptitle(nslc)
+    return fig
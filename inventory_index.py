@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Index of the stations and channels available from the waveform source
+
+The index is written to a JSON file shared by all gunicorn workers, so the
+archive is only scanned when the index is built. A background thread in each
+worker rebuilds it when it is older than the TTL, or for SDS archives when the
+network/station directories change, and only one worker rebuilds at a time.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from obspy import UTCDateTime
+
+class InventoryIndex:
+    def __init__(self, client, source, index_path, ttl=3600, check_interval=60, sds_path=None):
+        self.client = client
+        self.source = source
+        self.index_path = index_path
+        self.lock_path = index_path + '.lock'
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.sds_path = sds_path
+        self.index = None
+        self.index_mtime = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+
+    # Cheap fingerprint of the archive layout, changes when a network, station or channel directory is added
+    # The UTC date is included because the channel list only holds streams with data today
+    def signature(self):
+        parts = [UTCDateTime.now().strftime('%Y-%m-%d')]
+        if self.source == 'SDS':
+            year_dir = os.path.join(self.sds_path, str(UTCDateTime.now().year))
+            for path in [year_dir] + sorted(glob.glob(os.path.join(year_dir, '*'))) + sorted(glob.glob(os.path.join(year_dir, '*', '*'))):
+                try:
+                    parts.append('%s:%d' % (path, os.stat(path).st_mtime_ns))
+                except FileNotFoundError:
+                    pass
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    # Scan the waveform source
+    def build(self):
+        now = UTCDateTime.now()
+        if self.source == 'SDS':
+            stations = sorted(self.client.get_all_stations())
+            nslc = sorted(self.client.get_all_nslc(datetime=now))
+        else:
+            # CachedFDSNClient limits the request to the configured networks and stations
+            inv = self.client.get_stations(level='channel', starttime=now, endtime=now)
+            stations = set()
+            nslc = set()
+            for net in inv:
+                for sta in net:
+                    stations.add((net.code, sta.code))
+                    for cha in sta:
+                        nslc.add((net.code, sta.code, cha.location_code, cha.code))
+            stations = sorted(stations)
+            nslc = sorted(nslc)
+        return {'built': time.time(),
+                'signature': self.signature(),
+                'stations': [list(s) for s in stations],
+                'nslc': [list(n) for n in nslc]}
+
+    # Rebuild the index file, unless another worker is already doing it
+    def rebuild(self, wait=False):
+        with open(self.lock_path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                # The index may have been rebuilt while waiting for the lock
+                if wait and self.is_current(self.read_file()):
+                    return True
+                index = self.build()
+                fd, tmp_path = tempfile.mkstemp(prefix='.inventory.', dir=os.path.dirname(self.index_path))
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(index, f)
+                    os.replace(tmp_path, self.index_path)
+                except:
+                    os.unlink(tmp_path)
+                    raise
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return True
+
+    def read_file(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def is_current(self, index):
+        if index is None:
+            return False
+        if time.time() - index['built'] > self.ttl:
+            return False
+        return index['signature'] == self.signature()
+
+    # Background loop, checks the index every check_interval seconds
+    def refresh_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                if not self.is_current(self.read_file()):
+                    self.rebuild()
+            except Exception as error:
+                print("Failed to refresh inventory index: %s" % str(error))
+
+    # Start the refresh thread in this process, done on first use so it also runs after gunicorn forks
+    def start(self):
+        if self.thread_pid != os.getpid():
+            self.thread_pid = os.getpid()
+            self.thread = threading.Thread(target=self.refresh_loop, name='inventory-index', daemon=True)
+            self.thread.start()
+
+    # Current index, reloaded from the shared file when another worker has rebuilt it
+    def get(self):
+        with self.lock:
+            self.start()
+            try:
+                mtime = os.path.getmtime(self.index_path)
+            except FileNotFoundError:
+                self.rebuild(wait=True)
+                mtime = os.path.getmtime(self.index_path)
+            if mtime != self.index_mtime:
+                self.index = self.read_file()
+                self.index_mtime = mtime
+            return self.index
+
+    # Load the index in the gunicorn master before the workers are forked, without starting the refresh thread
+    def preload(self):
+        with self.lock:
+            if not self.is_current(self.read_file()):
+                self.rebuild(wait=True)
+            self.index_mtime = os.path.getmtime(self.index_path)
+            self.index = self.read_file()
+
+    # Form choices of NET.STA
+    def station_choices(self):
+        choices = []
+        for net, sta in self.get()['stations']:
+            net_sta = net + '.' + sta
+            choices.append((net_sta, net_sta))
+        return choices
+
+    # Form choices of NET.STA.LOC.CHA for channels starting with prefix
+    def channel_choices(self, prefix=''):
+        choices = []
+        for net, sta, loc, chan in self.get()['nslc']:
+            if chan.startswith(prefix):
+                nslc = net + '.' + sta + '.' + loc + '.' + chan
+                choices.append((nslc, nslc))
+        return choices
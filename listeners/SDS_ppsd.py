@@ -2,63 +2,223 @@
 """
 Created on Fri April 19 2024
 
+Computes PPSDs of the archived channels in a process pool, one job per channel.
+The PPSD of each channel and UTC day is kept as NSLC_YYYYMMDD.npz, and each run
+only adds the segments recorded since the last run. Daily plots are made from
+one day file, longer periods (e.g. weekly and monthly) by merging day files.
+Inventories and response curves come from a ResponseCache (response_cache.py),
+so StationXML files are only parsed again after they changed and CachedPPSD
+takes the response of each segment from the cached curves. Plots are
+linked into the web app and recorded in the PPSD catalogue (ppsd_catalog.py).
+
 @author: nnovoa
 """
 
+import argparse
+import fnmatch
+import glob
 import os
+import tempfile
+import warnings
+
+import matplotlib
+matplotlib.use('Agg')
 
-from obspy import read_inventory, UTCDateTime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from obspy import UTCDateTime
 from obspy.clients.filesystem.sds import Client
 from obspy.signal import PPSD
 
+import ppsd_catalog
+
+from response_cache import CachedPPSD, ResponseCache
+
 PPSD_path = os.path.join('/data', 'ppsd')
 SDS_path = os.path.join('/data', 'seiscomp', 'archive')
-client = Client(SDS_path)
+StaXML_path = os.path.join('/opt', 'seiscomp', 'StaXML')
+Link_path = os.path.join('/opt', 'scqcweb', 'static', 'ppsd')
+Cache_path = os.path.join(PPSD_path, 'inventory_cache')
+Catalog_path = os.path.join('/opt', 'scqcweb', 'listeners', 'ppsd_catalog.db')
+
+# Start times of the UTC days from days before etime up to the day of etime
+def ppsd_days(etime, days):
+    first = UTCDateTime((etime - days * 86400).date)
+    return [first + i * 86400 for i in range(days + 1)]
+
+# Channels matching the channel pattern with data on any of the days
+def find_channels(client, days, channel='HN?'):
+    channels = set()
+    for day in days:
+        for nslc in client.get_all_nslc(datetime=day):
+            if fnmatch.fnmatch(nslc[3], channel):
+                channels.add(nslc)
+    return sorted(channels)
+
+def npz_name(nslc, day):
+    return nslc + '_' + day.strftime("%Y%m%d") + '.npz'
+
+# Write a file through a temporary file in the same directory, so readers never see a partial file
+# write is called with the temporary path, suffix is kept because numpy and matplotlib pick the format from it
+def write_atomic(path, write, suffix):
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', suffix=suffix, dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+# Add the data recorded since the last run to the day file of one channel and day
+# Returns the PPSD (None if the day has no processed segments) and whether segments were added
+def update_day(client, cache, xml_path, inv, nslc, day, etime, station_dir):
+    npz_path = os.path.join(station_dir, npz_name(nslc, day))
+    ppsd = None
+    stime = day
+    if os.path.exists(npz_path):
+        ppsd = CachedPPSD.load_npz(npz_path)
+        ppsd.use_responses(cache, xml_path, inv)
+        if ppsd.times_processed:
+            # The last segment is already in the PPSD and is skipped by add
+            stime = max(day, ppsd.times_processed[-1])
+    net, sta, loc, cha = nslc.split('.')
+    # Read past midnight so the last segments of the day are complete, then trim so
+    # that no segment starting on the next day is added to this day
+    endtime = day + 86400 + 3600
+    if etime < endtime:
+        endtime = etime
+    st = client.get_waveforms(net, sta, loc, cha, stime, endtime)
+    if ppsd is None:
+        if len(st) == 0:
+            return None, False
+        ppsd = CachedPPSD(st[0].stats, metadata=inv)
+        ppsd.use_responses(cache, xml_path, inv)
+    st.trim(endtime=day + 86400 + ppsd.ppsd_length - ppsd.step / 2.0)
+    with warnings.catch_warnings():
+        # Segments already in the PPSD and traces shorter than ppsd_length are skipped with a warning
+        warnings.simplefilter('ignore')
+        changed = len(st) > 0 and ppsd.add(st)
+    if changed:
+        write_atomic(npz_path, ppsd.save_npz, '.npz')
+    if not ppsd.times_processed:
+        return None, False
+    return ppsd, changed
+
+def plot_ppsd(ppsd, plot_path):
+    write_atomic(plot_path, lambda path: ppsd.plot(filename=path, cumulative=True, xaxis_frequency=True), '.png')
+
+# Link new plots into the web app's static folder and add them to the catalogue
+def link_plots(conn, plots, link_dir):
+    for plot_path in plots:
+        link = os.path.join(link_dir, os.path.basename(plot_path))
+        if not os.path.lexists(link):
+            os.symlink(plot_path, link)
+    ppsd_catalog.add_plots(conn, [os.path.basename(plot_path) for plot_path in plots])
+
+# PPSD of the period days ending at day, merged from the day files
+def merge_days(nslc, day, period, station_dir):
+    ppsd = None
+    for i in range(period - 1, -1, -1):
+        npz_path = os.path.join(station_dir, npz_name(nslc, day - i * 86400))
+        if not os.path.exists(npz_path):
+            continue
+        if ppsd is None:
+            ppsd = PPSD.load_npz(npz_path)
+        else:
+            ppsd.add_npz(npz_path)
+    return ppsd
+
+# Update the day files of one channel, plot the updated days and, if any day was updated, the longer periods
+# Runs in a worker process, returns a list of log messages and the paths of the plots it wrote
+def process_channel(sds_path, ppsd_dir, staxml_dir, cache_dir, nslc, days, etime, periods, keep_days):
+    messages = []
+    plots = []
+    net, sta, loc, cha = nslc.split('.')
+    station_dir = os.path.join(ppsd_dir, net + '.' + sta)
+    os.makedirs(station_dir, exist_ok=True)
+    xml_name = net + '_' + sta + '.xml'
+    xml_path = os.path.join(staxml_dir, xml_name)
+    cache = ResponseCache(cache_dir)
+    try:
+        inv = cache.inventory(xml_path)
+    except Exception as error:
+        return ["Failed to read inventory {0}: {1}".format(xml_name, str(error))], plots
+    client = Client(sds_path)
+    last_day = None
+    for day in days:
+        try:
+            ppsd, changed = update_day(client, cache, xml_path, inv, nslc, day, etime, station_dir)
+            plot_path = os.path.join(station_dir, nslc + '_' + day.strftime("%Y%m%d") + '.png')
+            if ppsd is not None and (changed or not os.path.exists(plot_path)):
+                plot_ppsd(ppsd, plot_path)
+                plots.append(plot_path)
+                last_day = day
+        except Exception as error:
+            messages.append("Failed to calculate ppsd for {0} on {1}: {2}".format(nslc, day.strftime("%Y-%m-%d"), str(error)))
+    if last_day is not None:
+        for period in periods:
+            try:
+                ppsd = merge_days(nslc, last_day, period, station_dir)
+                plot_name = nslc + '_' + str(period) + 'd_' + last_day.strftime("%Y%m%d") + '.png'
+                plot_ppsd(ppsd, os.path.join(station_dir, plot_name))
+                plots.append(os.path.join(station_dir, plot_name))
+            except Exception as error:
+                messages.append("Failed to plot {0} day ppsd for {1}: {2}".format(period, nslc, str(error)))
+    # Remove day files older than keep_days
+    oldest = (days[-1] - keep_days * 86400).strftime("%Y%m%d")
+    for npz_path in glob.glob(os.path.join(station_dir, nslc + '_????????.npz')):
+        if npz_path[-12:-4] < oldest:
+            os.unlink(npz_path)
+    return messages, plots
 
 def main():
+    parser = argparse.ArgumentParser(description='Compute PPSDs of the SDS archive for scqcweb.')
+    parser.add_argument('--days', type=int, default=1, help='also update this many days before today (default 1)')
+    parser.add_argument('--periods', type=int, nargs='+', default=[7, 30], help='days covered by the plots besides the daily plots (default 7 30)')
+    parser.add_argument('--keep-days', type=int, default=60, help='days of PPSD files to keep (default 60)')
+    parser.add_argument('--channel', default='HN?', help='channels to process (default HN?)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default one per CPU)')
+    parser.add_argument('--ppsd-dir', default=PPSD_path, help='folder for PPSD files and plots')
+    parser.add_argument('--sds', default=SDS_path, help='SDS archive')
+    parser.add_argument('--staxml', default=StaXML_path, help='folder with NET_STA.xml inventories')
+    parser.add_argument('--cache-dir', default=Cache_path, help='folder for parsed inventories and response curves')
+    parser.add_argument('--link-dir', default=Link_path, help='web app folder to link plots into')
+    parser.add_argument('--catalog', default=Catalog_path, help='PPSD catalogue read by the web app')
+    parser.add_argument('--archive-days', type=int, default=90, help='move links of plots older than this many days into the archive folder (default 90)')
+    args = parser.parse_args()
+
     logf = open("SDS_ppsd.log", "w")
-    os.chdir(PPSD_path)
-    stations = client.get_all_stations()
     etime = UTCDateTime.now()
-    # Calculate starttime one day before end time
-    stime = etime - 86400
-    #stime = etime - 604800
-    for station in stations:
-        station_dir = station[0] + '.' + station[1]
-        if not os.path.exists(station_dir):
-            os.makedirs(station_dir)
-            print("Directory created successfully!")
-        os.chdir(station_dir)
-        xml_name = station[0] + '_' + station[1] + '.xml'
-        inv_path = os.path.join('/opt', 'seiscomp', 'StaXML', xml_name)
-        print("Inventory path is %s!" % inv_path)
-        try:
-            inv = read_inventory(inv_path)
-            st = client.get_waveforms(station[0], station[1], "*", "HN?", stime, etime)
-            print("Succefsully read inventory and waveforms for %s!" % xml_name)
-        except Exception as error:
-            logf.write("Failed to read inventory or collect waveforms for {0}: {1}\n".format(str(xml_name),str(error)))
-        finally:
-            pass
-        for tr in st:
-            span = tr.stats.endtime - tr.stats.starttime
-            if span >= 3600:
-                try:
-                    nslc = tr.stats.network + '.' + tr.stats.station + '.' + tr.stats.location + '.' + tr.stats.channel
-                    ppsd = PPSD(tr.stats, metadata=inv)
-                    ppsd.add(tr)
-                    plot_name = nslc + '_' + etime.strftime("%Y%m%d") + '.png'
-                    #npz_name = nslc + '_' + etime.strftime("%Y%m%d") + '.npz'
-                    ppsd.plot(filename=plot_name, cumulative=True, xaxis_frequency=True)
-                    #ppsd.save_npz(npz_name)
-                    plot_target = os.path.join(PPSD_path, station_dir, plot_name)
-                    SCQCW_link = os.path.join('/opt', 'scqcweb', 'static', 'ppsd', plot_name)
-                    os.symlink(plot_target, SCQCW_link)
-                except Exception as error:
-                    logf.write("Failed to calculate ppsd for {0}: {1}\n".format(str(nslc),str(error)))
-                finally:
-                    pass   
-        os.chdir(PPSD_path)               
+    days = ppsd_days(etime, args.days)
+    os.makedirs(args.link_dir, exist_ok=True)
+    conn = ppsd_catalog.connect(args.catalog)
+    ppsd_catalog.setup(conn)
+    if ppsd_catalog.is_empty(conn):
+        print("Catalogued %d existing plots" % ppsd_catalog.scan_links(conn, args.link_dir))
+    channels = find_channels(Client(args.sds), days, args.channel)
+    print("Processing %d channels with %d workers" % (len(channels), args.workers))
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = {}
+        for nslc in channels:
+            nslc = '.'.join(nslc)
+            jobs[pool.submit(process_channel, args.sds, args.ppsd_dir, args.staxml, args.cache_dir,
+                             nslc, days, etime, args.periods, args.keep_days)] = nslc
+        for job in as_completed(jobs):
+            try:
+                messages, plots = job.result()
+            except Exception as error:
+                messages, plots = ["Failed to process {0}: {1}".format(jobs[job], str(error))], []
+            try:
+                link_plots(conn, plots, args.link_dir)
+            except Exception as error:
+                messages.append("Failed to link plots of {0}: {1}".format(jobs[job], str(error)))
+            for message in messages:
+                logf.write(message + "\n")
+            print("Finished %s" % jobs[job])
+    print("Archived %d plots" % ppsd_catalog.archive(conn, args.link_dir, args.archive_days))
+    conn.close()
+    logf.close()
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
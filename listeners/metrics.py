@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Timing spans and counters of the hot paths, exported in the Prometheus text format
+Recorded by scqcweb.py, its render processes and scqc_listener.py
+
+Each process keeps its own histograms and counters and, once a folder is set
+with configure(), writes them to a JSON file named after its pid at most every
+flush_interval seconds. collect() sums the files of every process, so the
+/metrics route of any web worker reports the web workers, render processes and
+QC listener together. Spans recorded in a thread that started a trace are also
+kept for the Server-Timing header of its request.
+"""
+
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Files of processes that stopped are removed once they are this many seconds old
+STALE_SECONDS = 3600
+# Histogram of the timing spans, labelled with the span name
+SPAN_metric = 'scqcweb_span_seconds'
+
+HELP = {SPAN_metric: 'Time spent in archive reads, SQLite queries, QC store loads, figure building and PNG encoding',
+        'scqcweb_request_seconds': 'Time spent answering requests per route',
+        'scqcweb_requests_total': 'Requests answered per route and status',
+        'scqcweb_listener_flush_lag_seconds': 'Time from a QC message reaching the listener to its station being written to the QC store',
+        'scqcweb_listener_messages_total': 'QC parameters received by the listener',
+        'scqcweb_listener_flushes_total': 'Writes of the listener to the QC store'}
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.directory = None
+        self.flush_interval = 5
+        self.reset()
+
+    # Start from zero, also done on first use in a process forked after metrics were recorded
+    def reset(self):
+        self.pid = os.getpid()
+        # (name, labels) -> counts per bucket, count above the last bucket, sum of values
+        self.histograms = {}
+        # (name, labels) -> value
+        self.counters = {}
+        self.dirty = False
+        self.last_flush = time.time()
+
+    # Share the metrics of this process through files in directory, None keeps them in this process
+    def configure(self, directory, flush_interval=5):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def check_pid(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.check_pid()
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            values[bisect.bisect_left(BUCKETS, seconds)] += 1
+            values[-1] += seconds
+            self.dirty = True
+        self.maybe_flush()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.check_pid()
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.dirty = True
+        self.maybe_flush()
+
+    # Time the enclosed block as one span, e.g. with metrics.span('archive_read'):
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(SPAN_metric, seconds, span=name)
+            trace = getattr(self.local, 'trace', None)
+            if trace is not None:
+                trace.append((name, seconds))
+
+    # Keep the spans of this thread until end_trace(), used for the Server-Timing header
+    def start_trace(self):
+        self.local.trace = []
+
+    # Stop keeping spans and return them as a list of (name, seconds)
+    def end_trace(self):
+        trace = getattr(self.local, 'trace', None)
+        self.local.trace = None
+        return trace or []
+
+    def maybe_flush(self):
+        if self.directory and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    # Write the metrics of this process to its file, if anything changed since the last write
+    def flush(self):
+        if not self.directory:
+            return
+        with self.lock:
+            self.check_pid()
+            if not self.dirty:
+                return
+            snapshot = {'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()],
+                        'counters': [[name, labels, value] for (name, labels), value in self.counters.items()]}
+            self.dirty = False
+            self.last_flush = time.time()
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, os.path.join(self.directory, '%d.json' % self.pid))
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    # Sum the metrics of every process sharing the folder, or of this process only
+    # Returns (histograms, counters) keyed by (name, labels)
+    def collect(self):
+        if not self.directory:
+            with self.lock:
+                self.check_pid()
+                return {key: list(values) for key, values in self.histograms.items()}, dict(self.counters)
+        self.flush()
+        histograms = {}
+        counters = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+                if not process_running(int(filename[:-len('.json')])) and time.time() - os.path.getmtime(path) > STALE_SECONDS:
+                    os.unlink(path)
+            except (OSError, ValueError):
+                continue
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    # All metrics in the Prometheus text exposition format
+    def render(self):
+        histograms, counters = self.collect()
+        lines = []
+        for name in sorted(set(name for name, labels in histograms)):
+            header(lines, name, 'histogram')
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ['+Inf'], values[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', str(bound)),)), cumulative))
+                lines.append('%s_sum%s %r' % (name, format_labels(labels), float(values[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+        for name in sorted(set(name for name, labels in counters)):
+            header(lines, name, 'counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('%s%s %r' % (name, format_labels(labels), float(value)))
+        return '\n'.join(lines) + '\n'
+
+def header(lines, name, kind):
+    if name in HELP:
+        lines.append('# HELP %s %s' % (name, HELP[name]))
+    lines.append('# TYPE %s %s' % (name, kind))
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels]
+    return '{' + ','.join(escaped) + '}'
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user, e.g. the QC listener
+        return True
+    return True
+
+# Metrics of this process
+registry = Registry()
+configure = registry.configure
+observe = registry.observe
+inc = registry.inc
+span = registry.span
+start_trace = registry.start_trace
+end_trace = registry.end_trace
+flush = registry.flush
+render = registry.render
+
+atexit.register(registry.flush)
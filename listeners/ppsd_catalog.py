@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Catalogue of the PPSD plots linked into the web app's static/ppsd folder
+
+SDS_ppsd.py adds a row for every plot it links, and the PPSD page queries the
+catalogue by station and date instead of listing the folder. Links of plots
+older than the archive age are moved into monthly folders under
+static/ppsd/archive, so static/ppsd itself only holds recent plots.
+"""
+
+import os
+import re
+import sqlite3
+import time
+
+from datetime import datetime, timedelta, timezone
+
+# Plot file names written by SDS_ppsd.py, NSLC_YYYYMMDD.png for daily plots and NSLC_<days>d_YYYYMMDD.png for longer periods
+PLOT_name = re.compile(r'^(?P<nslc>[^_]+)_((?P<period>\d+)d_)?(?P<day>\d{8})\.png$')
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+def setup(conn):
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS plots (
+                filename TEXT PRIMARY KEY,
+                station TEXT,
+                nslc TEXT,
+                period INTEGER,
+                day TEXT,
+                url TEXT,
+                updated REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS plots_station_day ON plots (station, day)")
+        conn.execute("CREATE INDEX IF NOT EXISTS plots_day ON plots (day)")
+
+# Split a plot file name into (nslc, period in days, day as YYYY-MM-DD), or None if it is not a PPSD plot
+def parse_name(filename):
+    match = PLOT_name.match(filename)
+    if match is None:
+        return None
+    day = match.group('day')
+    return match.group('nslc'), int(match.group('period') or 1), day[0:4] + '-' + day[4:6] + '-' + day[6:8]
+
+# Add or update plots, entries is a list of file names relative to the static/ppsd folder
+def add_plots(conn, entries):
+    rows = []
+    now = time.time()
+    for entry in entries:
+        filename = os.path.basename(entry)
+        parsed = parse_name(filename)
+        if parsed is None:
+            continue
+        nslc, period, day = parsed
+        station = '.'.join(nslc.split('.')[0:2])
+        rows.append((filename, station, nslc, period, day, 'ppsd/' + entry, now))
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO plots (filename, station, nslc, period, day, url, updated) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+# Catalogue the plots already in the link folder and its archive, used once to fill a new catalogue
+def scan_links(conn, link_dir):
+    entries = [name for name in os.listdir(link_dir) if name.endswith('.png')]
+    archive_dir = os.path.join(link_dir, 'archive')
+    if os.path.isdir(archive_dir):
+        for month in os.listdir(archive_dir):
+            entries += ['archive/' + month + '/' + name for name in os.listdir(os.path.join(archive_dir, month)) if name.endswith('.png')]
+    return add_plots(conn, entries)
+
+def is_empty(conn):
+    return conn.execute("SELECT 1 FROM plots LIMIT 1").fetchone() is None
+
+# Move the links of plots older than keep_days into static/ppsd/archive/YYYYMM and update their urls
+def archive(conn, link_dir, keep_days):
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    moved = []
+    for filename, day in conn.execute("SELECT filename, day FROM plots WHERE day < ? AND url NOT LIKE 'ppsd/archive/%'", (cutoff,)).fetchall():
+        month = day[0:4] + day[5:7]
+        month_dir = os.path.join(link_dir, 'archive', month)
+        os.makedirs(month_dir, exist_ok=True)
+        try:
+            os.replace(os.path.join(link_dir, filename), os.path.join(month_dir, filename))
+        except FileNotFoundError:
+            pass
+        moved.append(('ppsd/archive/' + month + '/' + filename, filename))
+    with conn:
+        conn.executemany("UPDATE plots SET url = ? WHERE filename = ?", moved)
+    return len(moved)
+
+# WHERE clause and parameters selecting the plots of a station, optionally limited to days from start to end (YYYY-MM-DD) and one period
+def filters(station, start=None, end=None, period=None):
+    where = "station = ?"
+    params = [station]
+    if start:
+        where += " AND day >= ?"
+        params.append(start)
+    if end:
+        where += " AND day <= ?"
+        params.append(end)
+    if period:
+        where += " AND period = ?"
+        params.append(period)
+    return where, params
+
+# Number of plots matching the filters, used to clamp the page before query()
+def count(conn, station, start=None, end=None, period=None):
+    where, params = filters(station, start, end, period)
+    return conn.execute("SELECT COUNT(*) FROM plots WHERE " + where, params).fetchone()[0]
+
+# Plots of a station matching the filters, newest first
+# Returns the rows (url, nslc, period, day) of one page
+def query(conn, station, start=None, end=None, period=None, limit=24, offset=0):
+    where, params = filters(station, start, end, period)
+    return conn.execute("SELECT url, nslc, period, day FROM plots WHERE " + where + " ORDER BY day DESC, period, nslc LIMIT ? OFFSET ?",
+                        params + [limit, offset]).fetchall()
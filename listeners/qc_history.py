@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+History of the QC parameters of every channel, for trends over days and weeks
+Written by scqc_listener.py and read by scqcweb.py
+
+Every QC value received is appended as a fixed-width (time, value) record to a
+raw file per UTC day, channel (NSLC) and parameter. Values are also summed into
+hourly and daily tiers, which hold one fixed-width (sum, min, max, count) slot
+per hour of a month or per day of a year, so a slot is updated in place and a
+trend over weeks reads a few small files. All files are plain numpy records
+that readers map without parsing. Partitions older than the retention of their
+tier are removed by prune().
+
+    <root>/raw/YYYYMMDD/NET.STA.LOC.CHA/<parameter>.bin
+    <root>/1hour/YYYYMM/NET.STA.LOC.CHA/<parameter>.bin
+    <root>/1day/YYYY/NET.STA.LOC.CHA/<parameter>.bin
+"""
+
+import calendar
+import os
+import shutil
+import time
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+app_path = os.path.dirname(os.path.abspath(__file__))
+QC_history_path = os.path.join(app_path, 'qc_history')
+
+RAW_dtype = np.dtype([('time', '<f8'), ('value', '<f4')])
+SLOT_dtype = np.dtype([('sum', '<f8'), ('min', '<f4'), ('max', '<f4'), ('count', '<u4')])
+
+# Tiers as (name, seconds per slot, partition format), the raw tier has no slots
+TIERS = [('raw', 0, '%Y%m%d'),
+         ('1hour', 3600, '%Y%m'),
+         ('1day', 86400, '%Y')]
+
+# Default days of data kept per tier, 0 keeps data forever
+RETENTION = {'raw': 31,
+             '1hour': 730,
+             '1day': 0}
+
+def utc(t):
+    return datetime.fromtimestamp(t, timezone.utc)
+
+# Start (epoch seconds) and number of slots of the partition of a tier holding time t
+def partition_span(tier, t):
+    day = utc(t)
+    if tier == '1hour':
+        start = datetime(day.year, day.month, 1, tzinfo=timezone.utc)
+        return start.timestamp(), calendar.monthrange(day.year, day.month)[1] * 24
+    start = datetime(day.year, 1, 1, tzinfo=timezone.utc)
+    return start.timestamp(), 366
+
+class QCHistory:
+    def __init__(self, root=QC_history_path, retention=RETENTION):
+        self.root = root
+        self.retention = retention
+        # Records waiting for flush(), (NSLC, parameter) -> list of (time, value)
+        self.pending = {}
+        self.last_prune = 0
+
+    def path(self, tier, partition, nslc, param):
+        return os.path.join(self.root, tier, partition, nslc, param + '.bin')
+
+    # Keep a value for the next flush, t is epoch seconds
+    def append(self, nslc, param, t, value):
+        self.pending.setdefault((nslc, param), []).append((t, value))
+
+    # Append the pending values to the raw files and add them to the tier slots
+    def flush(self):
+        pending = self.pending
+        self.pending = {}
+        for (nslc, param), values in pending.items():
+            records = np.array(values, dtype=RAW_dtype)
+            records.sort(order='time')
+            self.write_raw(nslc, param, records)
+            for tier, seconds, fmt in TIERS[1:]:
+                self.write_slots(tier, seconds, fmt, nslc, param, records)
+        # Pruning lists every partition, so it is done at most hourly
+        if time.time() - self.last_prune >= 3600:
+            self.prune()
+            self.last_prune = time.time()
+
+    def write_raw(self, nslc, param, records):
+        days = (records['time'] // 86400).astype(np.int64)
+        for day in np.unique(days):
+            path = self.path('raw', utc(day * 86400).strftime('%Y%m%d'), nslc, param)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                f.write(records[days == day].tobytes())
+
+    # Merge the records into the slots of a tier, creating partition files at their full size
+    def write_slots(self, tier, seconds, fmt, nslc, param, records):
+        buckets = (records['time'] // seconds).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        values = records['value'].astype(np.float64)
+        sums = np.add.reduceat(values, starts)
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        counts = np.diff(np.append(starts, len(records)))
+        slots = None
+        current = None
+        for bucket, total, low, high, count in zip(buckets[starts], sums, mins, maxs, counts):
+            t = float(bucket * seconds)
+            partition = utc(t).strftime(fmt)
+            if partition != current:
+                if slots is not None:
+                    slots.flush()
+                slots = self.open_slots(tier, partition, nslc, param, t)
+                current = partition
+            first, size = partition_span(tier, t)
+            i = int((t - first) // seconds)
+            if slots['count'][i] == 0:
+                slots['min'][i] = low
+                slots['max'][i] = high
+            else:
+                slots['min'][i] = min(slots['min'][i], low)
+                slots['max'][i] = max(slots['max'][i], high)
+            slots['sum'][i] += total
+            slots['count'][i] += count
+        if slots is not None:
+            slots.flush()
+
+    def open_slots(self, tier, partition, nslc, param, t):
+        path = self.path(tier, partition, nslc, param)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            first, size = partition_span(tier, t)
+            np.zeros(size, dtype=SLOT_dtype).tofile(path)
+        return np.memmap(path, dtype=SLOT_dtype, mode='r+')
+
+    # Remove the partitions older than the retention of each tier
+    def prune(self, now=None):
+        now = utc(now if now is not None else time.time())
+        for tier, seconds, fmt in TIERS:
+            days = self.retention.get(tier, 0)
+            if days <= 0:
+                continue
+            # A partition is removed once its last day is older than the retention
+            cutoff = (now - timedelta(days=days)).strftime(fmt)
+            for partition in self.partitions(tier):
+                if partition < cutoff:
+                    shutil.rmtree(os.path.join(self.root, tier, partition), ignore_errors=True)
+
+    def partitions(self, tier):
+        try:
+            return sorted(os.listdir(os.path.join(self.root, tier)))
+        except FileNotFoundError:
+            return []
+
+    # Partitions of a tier overlapping start to end (epoch seconds)
+    def partitions_between(self, tier, fmt, start, end):
+        first = utc(start).strftime(fmt)
+        last = utc(end).strftime(fmt)
+        return [partition for partition in self.partitions(tier) if first <= partition <= last]
+
+    # Channels of a station (NET.STA) with data of a tier in the partitions
+    def channels(self, tier, partitions, sta_id):
+        channels = set()
+        for partition in partitions:
+            try:
+                names = os.listdir(os.path.join(self.root, tier, partition))
+            except FileNotFoundError:
+                continue
+            channels.update(name for name in names if name.startswith(sta_id + '.'))
+        return sorted(channels)
+
+    # Pick the coarsest tier with at least min_points slots in the range that still holds data from start
+    def choose_tier(self, start, end, min_points):
+        span = end - start
+        tiers = [(tier, fmt) for tier, seconds, fmt in TIERS if seconds * min_points <= span]
+        for tier, fmt in reversed(tiers):
+            partitions = self.partitions(tier)
+            if partitions and partitions[0] <= utc(start).strftime(fmt):
+                return tier, fmt
+        # No tier reaches back to start, use the finest one that may still have data
+        return tiers[0]
+
+    # Read a parameter of every channel of a station between start and end (epoch seconds)
+    # Returns the tier and a dictionary of NSLC to a dictionary of arrays: time and value for the raw tier,
+    # time (slot start), mean, min, max and count for the other tiers
+    def query(self, sta_id, param, start, end, min_points):
+        tier, fmt = self.choose_tier(start, end, min_points)
+        seconds = dict((name, slot_seconds) for name, slot_seconds, partition_fmt in TIERS)[tier]
+        partitions = self.partitions_between(tier, fmt, start, end)
+        series = {}
+        for nslc in self.channels(tier, partitions, sta_id):
+            parts = []
+            for partition in partitions:
+                path = self.path(tier, partition, nslc, param)
+                if tier == 'raw':
+                    records = read_records(path, RAW_dtype)
+                    keep = (records['time'] >= start) & (records['time'] <= end)
+                    parts.append({'time': records['time'][keep], 'value': records['value'][keep]})
+                else:
+                    slots = read_records(path, SLOT_dtype)
+                    first, size = partition_span(tier, datetime.strptime(partition, fmt).replace(tzinfo=timezone.utc).timestamp())
+                    times = first + np.arange(len(slots)) * seconds
+                    keep = (slots['count'] > 0) & (times >= start - seconds) & (times <= end)
+                    slots = slots[keep]
+                    parts.append({'time': times[keep],
+                                  'mean': slots['sum'] / slots['count'],
+                                  'min': slots['min'],
+                                  'max': slots['max'],
+                                  'count': slots['count']})
+            if parts:
+                merged = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+                # Late values are appended after newer ones
+                if tier == 'raw' and np.any(np.diff(merged['time']) < 0):
+                    order = np.argsort(merged['time'], kind='stable')
+                    merged = {key: values[order] for key, values in merged.items()}
+                if len(merged['time']) > 0:
+                    series[nslc] = merged
+        return tier, series
+
+# Whole records of a file, mapped instead of read, an empty array if the file is missing
+# A raw file may be read while a record is being appended, so a partial last record is left out
+def read_records(path, dtype):
+    try:
+        count = os.path.getsize(path) // dtype.itemsize
+    except FileNotFoundError:
+        count = 0
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
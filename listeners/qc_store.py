@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Storage for the latest QC parameters of each station
+Written by scqc_listener.py and read by scqcweb.py
+
+The default backend is a SQLite database in WAL mode keyed by NET.STA, so the
+listener can upsert single rows while any number of web workers read without
+blocking it. The original pickled dictionary is kept as a legacy backend.
+"""
+
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+app_path = os.path.dirname(os.path.abspath(__file__))
+QC_db_path = os.path.join(app_path, 'QC_store.db')
+QC_pkl_path = os.path.join(app_path, 'QC_dictionary.pkl')
+
+# Database columns in the same order as the QC headers used by the listener and web app
+QC_columns = ['latency', 'delay', 'timing_quality', 'gaps_count', 'overlaps_count', 'availability']
+
+class SQLiteQCStore:
+    def __init__(self, path=QC_db_path):
+        self.path = path
+        conn = self.connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS qc (
+                    sta_id TEXT PRIMARY KEY,
+                    latency REAL,
+                    delay REAL,
+                    timing_quality REAL,
+                    gaps_count REAL,
+                    overlaps_count REAL,
+                    availability REAL,
+                    updated REAL
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Replace the station list, keeping values of stations that are still active
+    def seed(self, sta_list):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("CREATE TEMP TABLE active (sta_id TEXT PRIMARY KEY)")
+                conn.executemany("INSERT OR IGNORE INTO active (sta_id) VALUES (?)", [(ns,) for ns in sta_list])
+                conn.execute("DELETE FROM qc WHERE sta_id NOT IN (SELECT sta_id FROM active)")
+                conn.execute("INSERT OR IGNORE INTO qc (sta_id) SELECT sta_id FROM active")
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        finally:
+            conn.close()
+
+    # Write changed stations, rows is a dictionary of NET.STA to list of QC values
+    def upsert(self, rows):
+        if not rows:
+            return
+        now = time.time()
+        params = [(sta_id,) + tuple(values) + (now,) for sta_id, values in rows.items()]
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO qc (sta_id, " + ", ".join(QC_columns) + ", updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", params)
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        finally:
+            conn.close()
+
+    # Return all stations as a dictionary of NET.STA to list of QC values
+    def load(self):
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT sta_id, " + ", ".join(QC_columns) + " FROM qc").fetchall()
+        finally:
+            conn.close()
+        return {row[0]: list(row[1:]) for row in rows}
+
+    # Counter that increases every time the store is written
+    def version(self):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        finally:
+            conn.close()
+        return row[0]
+
+    # Time (epoch seconds) of the most recent station update
+    def last_update(self):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT MAX(updated) FROM qc").fetchone()
+        finally:
+            conn.close()
+        return row[0]
+
+    def is_empty(self):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT COUNT(*) FROM qc").fetchone()
+        finally:
+            conn.close()
+        return row[0] == 0
+
+    # Import values from a legacy QC_dictionary.pkl
+    def migrate_pickle(self, pkl_path=QC_pkl_path):
+        with open(pkl_path, 'rb') as f:
+            QC_dict = pickle.load(f)
+        self.upsert(QC_dict)
+
+class PickleQCStore:
+    # Legacy backend, every write rewrites the whole dictionary
+    def __init__(self, path=QC_pkl_path):
+        self.path = path
+
+    def seed(self, sta_list):
+        QC_dict = {}
+        for ns in sta_list:
+            QC_dict.update({ns: [None] * len(QC_columns)})
+        self.write_snapshot(QC_dict)
+
+    def upsert(self, rows):
+        if not rows:
+            return
+        try:
+            QC_dict = self.load()
+        except FileNotFoundError:
+            QC_dict = {}
+        QC_dict.update(rows)
+        self.write_snapshot(QC_dict)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
+
+    def version(self):
+        return os.stat(self.path).st_mtime_ns
+
+    def last_update(self):
+        return os.path.getmtime(self.path)
+
+    def is_empty(self):
+        return not os.path.exists(self.path)
+
+    # Write the dictionary to a temporary file and rename it over the old one,
+    # so readers never see a half-written file
+    def write_snapshot(self, QC_dict):
+        fd, tmp_path = tempfile.mkstemp(prefix='.QC_dictionary.', dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(QC_dict, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+# Open the QC store selected by the qc_store option in config.ini, path overrides the default file of the backend
+def open_store(backend='sqlite', path=None):
+    if backend == 'pickle':
+        return PickleQCStore(path or QC_pkl_path)
+    elif backend == 'sqlite':
+        return SQLiteQCStore(path or QC_db_path)
+    else:
+        raise ValueError("Unknown QC store backend: %s" % backend)
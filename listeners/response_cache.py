@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of parsed StationXML inventories and instrument response curves
+
+Parsed inventories are pickled, keyed by the StationXML path and checked
+against the file's modification time and size, so a file is only parsed again
+after it changed. Response curves are evaluated once per channel, sampling
+interval and FFT length and kept as .npz files next to the pickles.
+CachedPPSD looks the response of each segment up in these curves, so PPSD does
+not run evalresp for every segment it processes.
+"""
+
+import glob
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from obspy import read_inventory, UTCDateTime
+from obspy.signal import PPSD
+
+# Limits of channel epochs without start or end date, within the range of nanosecond timestamps
+RESP_open_start = UTCDateTime(1900, 1, 1)
+RESP_open_end = UTCDateTime(2200, 1, 1)
+
+class ResponseCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_key(self, xml_path):
+        return hashlib.sha1(os.path.abspath(xml_path).encode('utf-8')).hexdigest()
+
+    def signature(self, xml_path):
+        info = os.stat(xml_path)
+        return (info.st_mtime_ns, info.st_size)
+
+    def write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    # Parsed inventory of a StationXML file, parsing the file only if it changed since it was cached
+    def inventory(self, xml_path):
+        key = self.path_key(xml_path)
+        signature = self.signature(xml_path)
+        pkl_path = os.path.join(self.cache_dir, 'inv_' + key + '.pkl')
+        try:
+            with open(pkl_path, 'rb') as f:
+                cached_signature, inv = pickle.load(f)
+            if cached_signature == signature:
+                return inv
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+        inv = read_inventory(xml_path)
+        self.write(pkl_path, pickle.dumps((signature, inv), protocol=pickle.HIGHEST_PROTOCOL))
+        # Response curves of the old file are no longer valid
+        for resp_path in glob.glob(os.path.join(self.cache_dir, 'resp_' + key + '_*.npz')):
+            try:
+                os.unlink(resp_path)
+            except FileNotFoundError:
+                pass
+        return inv
+
+    # Velocity response of every epoch of seed_id for an FFT of nfft samples at sampling interval delta
+    # Returns a list of dictionaries with start_time, end_time and response, as used by CachedPPSD
+    def responses(self, xml_path, seed_id, delta, nfft):
+        key = self.path_key(xml_path)
+        signature = self.signature(xml_path)
+        curve_key = hashlib.sha1(repr((signature, seed_id, float(delta), int(nfft))).encode('utf-8')).hexdigest()
+        npz_path = os.path.join(self.cache_dir, 'resp_' + key + '_' + curve_key + '.npz')
+        try:
+            with np.load(npz_path) as data:
+                return [{'seed_id': seed_id,
+                         'start_time': UTCDateTime(ns=int(start)),
+                         'end_time': UTCDateTime(ns=int(end)),
+                         'response': response}
+                        for start, end, response in zip(data['start'], data['end'], data['response'])]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        inv = self.inventory(xml_path)
+        net, sta, loc, cha = seed_id.split('.')
+        result = []
+        for network in inv.select(network=net, station=sta, location=loc, channel=cha):
+            for station in network:
+                for channel in station:
+                    response = inv.get_response(seed_id, (channel.start_date or RESP_open_start) + 10)
+                    result.append({'seed_id': seed_id,
+                                   'start_time': channel.start_date or RESP_open_start,
+                                   'end_time': channel.end_date or RESP_open_end,
+                                   'response': response.get_evalresp_response(t_samp=delta, nfft=nfft, output='VEL')[0]})
+        output = io.BytesIO()
+        np.savez(output,
+                 start=np.array([d['start_time'].ns for d in result], dtype=np.int64),
+                 end=np.array([d['end_time'].ns for d in result], dtype=np.int64),
+                 response=np.array([d['response'] for d in result], dtype=np.complex128).reshape(len(result), -1))
+        self.write(npz_path, output.getvalue())
+        return result
+
+# PPSD taking the response of each segment from the cached curves of its channel epochs
+# Segments outside every epoch fall back to PPSD's own lookup in the metadata
+class CachedPPSD(PPSD):
+    # Set by use_responses(), a list of epochs as returned by ResponseCache.responses
+    response_epochs = ()
+
+    # Use the cached curves of xml_path for this PPSD, keeping inv as metadata for the fallback
+    def use_responses(self, cache, xml_path, inv):
+        self.metadata = inv
+        self.response_epochs = cache.responses(xml_path, self.id, self.delta, self.nfft)
+
+    def _get_response(self, tr):
+        starttime = tr.stats.starttime
+        for epoch in self.response_epochs:
+            if epoch['start_time'] <= starttime < epoch['end_time']:
+                return epoch['response']
+        return PPSD._get_response(self, tr)
+
+    # PPSD.load_npz always creates a PPSD, so the loaded object is given this class
+    @staticmethod
+    def load_npz(filename, metadata=None):
+        ppsd = PPSD.load_npz(filename, metadata=metadata)
+        ppsd.__class__ = CachedPPSD
+        return ppsd
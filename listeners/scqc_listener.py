@@ -1,17 +1,50 @@
 #!/usr/bin/env seiscomp-python
 # -*- coding: utf-8 -*-
 
+import configparser
 import sys
+import time
 import traceback
-import pickle
 import os
 
 from seiscomp import core, client, datamodel
 
-app_path = os.path.dirname(__file__)
-QC_path = os.path.join(app_path, 'QC_dictionary.pkl')
-# List of QC parameters collected by QCListener in correct order written to QC dictionary
+import metrics
+import qc_history
+import qc_store
+
+app_path = os.path.dirname(os.path.abspath(__file__))
+# List of QC parameters collected by QCListener in correct order written to QC store
 QC_headers = ['Latency (s)', 'Delay (s)', 'Timing Quality', 'Gaps Count', 'Overlaps Count', 'Availability (%)']
+# Lookup table of SeisComP QC parameter name to column in QC store
+QC_params = {'latency': 0,
+             'delay': 1,
+             'timing quality': 2,
+             'gaps count': 3,
+             'overlaps count': 4,
+             'availability': 5
+             }
+
+# Read listener settings from the scqcweb config.ini file
+config = configparser.ConfigParser()
+config.read(os.path.join(app_path, '..', 'config.ini'))
+# QC store backend, either sqlite or the legacy pickle
+QC_backend = config.get('Listener', 'qc_store', fallback='sqlite')
+# QC store file, empty uses listeners/QC_store.db or listeners/QC_dictionary.pkl
+QC_path = config.get('Listener', 'qc_path', fallback='') or None
+# Seconds between flushes of the QC dictionary to disk
+flush_interval = config.getint('Listener', 'flush_interval', fallback=5)
+# Number of pending updates that forces a flush before the interval has elapsed
+flush_threshold = config.getint('Listener', 'flush_threshold', fallback=1000)
+# History of every QC value per channel, read by the web app for trends
+QC_history_dir = config.get('Listener', 'qc_history_dir', fallback='') or qc_history.QC_history_path
+QC_history_retention = {'raw': config.getint('Listener', 'qc_history_raw_days', fallback=qc_history.RETENTION['raw']),
+                        '1hour': config.getint('Listener', 'qc_history_1hour_days', fallback=qc_history.RETENTION['1hour']),
+                        '1day': config.getint('Listener', 'qc_history_1day_days', fallback=qc_history.RETENTION['1day'])}
+# Folder shared with the web app for the /metrics route, empty keeps the listener metrics to itself
+metrics_dir = config.get('Metrics', 'metrics_dir', fallback='metrics')
+if metrics_dir:
+    metrics.configure(os.path.join(app_path, '..', metrics_dir), flush_interval=config.getint('Metrics', 'flush_interval', fallback=5))
 
 class InventoryReader(client.Application):
     def __init__(self, argc, argv):
@@ -58,12 +91,11 @@ class InventoryReader(client.Application):
                 net_sta = network.code() + '.' + station.code()
                 if net_sta not in sta_list:
                     sta_list.append(net_sta)
-        QC_dict = {}
-        for ns in sta_list:
-            val = None
-            QC_dict.update({ns:[val,val,val,val,val,val]})
-        with open(QC_path, 'wb') as f:
-            pickle.dump(QC_dict, f)
+        store = qc_store.open_store(QC_backend, QC_path)
+        # Carry over values from a legacy QC_dictionary.pkl the first time the SQLite store is used
+        if QC_backend == 'sqlite' and store.is_empty() and os.path.exists(qc_store.QC_pkl_path):
+            store.migrate_pickle()
+        store.seed(sta_list)
             
         return True
     
@@ -79,6 +111,25 @@ class QCListener(client.Application):
         self.setPrimaryMessagingGroup(client.Protocol.LISTENER_GROUP)
         self.addMessagingSubscription("QC")
         self.setLoggingToStdErr(False)
+        # QC dictionary is kept in memory and changed stations are flushed to the QC store by flush()
+        self.store = qc_store.open_store(QC_backend, QC_path)
+        # Every value is also kept in the QC history, written on the same flushes
+        self.history = qc_history.QCHistory(QC_history_dir, QC_history_retention)
+        self.QC_dict = {}
+        # Changed stations and the time their oldest unwritten update arrived
+        self.dirty = {}
+        self.pending = 0
+        self.flush_count = 0
+        self.update_count = 0
+        self.last_flush = time.time()
+
+    def init(self):
+        if not client.Application.init(self):
+            return False
+        # Start from the stations seeded by InventoryReader
+        self.QC_dict = self.store.load()
+        self.enableTimer(1)
+        return True
 
     def run(self):
         try:
@@ -93,57 +144,70 @@ class QCListener(client.Application):
         try:
             dm = core.DataMessage.Cast(msg)
             if dm:
-                with open(QC_path, 'rb') as file:
-                    QC_dict = pickle.load(file)
                 for att in dm:
                     wfq = datamodel.WaveformQuality.Cast(att)
-                    if wfq.parameter() == 'latency':
-                        print("%s.%s.%s.%s" % (wfq.waveformID().networkCode(), wfq.waveformID().stationCode(), wfq.waveformID().locationCode(), wfq.waveformID().channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
-                        staID = str(wfq.waveformID().networkCode()) + "." + str(wfq.waveformID().stationCode())
-                        latency = round(wfq.value(),1)
-                        QC_dict[staID][0] = latency
-                        with open(QC_path, 'wb') as f:
-                            pickle.dump(QC_dict, f)
-                    if wfq.parameter() == 'delay':
-                        print("%s.%s.%s.%s" % (wfq.waveformID().networkCode(), wfq.waveformID().stationCode(), wfq.waveformID().locationCode(), wfq.waveformID().channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
-                        staID = str(wfq.waveformID().networkCode()) + "." + str(wfq.waveformID().stationCode())
-                        delay = round(wfq.value(),1)
-                        QC_dict[staID][1] = delay
-                        with open(QC_path, 'wb') as f:
-                            pickle.dump(QC_dict, f)
-                    if wfq.parameter() == 'timing quality':
-                        print("%s.%s.%s.%s" % (wfq.waveformID().networkCode(), wfq.waveformID().stationCode(), wfq.waveformID().locationCode(), wfq.waveformID().channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
-                        staID = str(wfq.waveformID().networkCode()) + "." + str(wfq.waveformID().stationCode())
-                        timing_quality = round(wfq.value(),1)
-                        QC_dict[staID][2] = timing_quality
-                        with open(QC_path, 'wb') as f:
-                            pickle.dump(QC_dict, f)
-                    if wfq.parameter() == 'gaps count':
-                        print("%s.%s.%s.%s" % (wfq.waveformID().networkCode(), wfq.waveformID().stationCode(), wfq.waveformID().locationCode(), wfq.waveformID().channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
-                        staID = str(wfq.waveformID().networkCode()) + "." + str(wfq.waveformID().stationCode())
-                        gaps_count = round(wfq.value(),1)
-                        QC_dict[staID][3] = gaps_count
-                        with open(QC_path, 'wb') as f:
-                            pickle.dump(QC_dict, f)
-                    if wfq.parameter() == 'overlaps count':
-                        print("%s.%s.%s.%s" % (wfq.waveformID().networkCode(), wfq.waveformID().stationCode(), wfq.waveformID().locationCode(), wfq.waveformID().channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
-                        staID = str(wfq.waveformID().networkCode()) + "." + str(wfq.waveformID().stationCode())
-                        overlaps_count = round(wfq.value(),1)
-                        QC_dict[staID][4] = overlaps_count
-                        with open(QC_path, 'wb') as f:
-                            pickle.dump(QC_dict, f)
-                    if wfq.parameter() == 'availability':
-                        print("%s.%s.%s.%s" % (wfq.waveformID().networkCode(), wfq.waveformID().stationCode(), wfq.waveformID().locationCode(), wfq.waveformID().channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
-                        staID = str(wfq.waveformID().networkCode()) + "." + str(wfq.waveformID().stationCode())
-                        availability = round(wfq.value(),1)
-                        QC_dict[staID][5] = availability
-                        with open(QC_path, 'wb') as f:
-                            pickle.dump(QC_dict, f)
+                    if wfq is None:
+                        continue
+                    idx = QC_params.get(wfq.parameter())
+                    if idx is None:
+                        continue
+                    wid = wfq.waveformID()
+                    print("%s.%s.%s.%s" % (wid.networkCode(), wid.stationCode(), wid.locationCode(), wid.channelCode()), wfq.start(), wfq.type(), wfq.parameter(), wfq.value())
+                    staID = str(wid.networkCode()) + "." + str(wid.stationCode())
+                    if staID not in self.QC_dict:
+                        self.QC_dict[staID] = [None] * len(QC_headers)
+                    self.QC_dict[staID][idx] = round(wfq.value(), 1)
+                    start = wfq.start()
+                    self.history.append("%s.%s.%s.%s" % (wid.networkCode(), wid.stationCode(), wid.locationCode(), wid.channelCode()),
+                                        qc_store.QC_columns[idx], start.seconds() + start.microseconds() * 1e-6, wfq.value())
+                    self.dirty.setdefault(staID, time.time())
+                    self.pending += 1
+                    metrics.inc('scqcweb_listener_messages_total')
+                if self.pending >= flush_threshold:
+                    self.flush()
         except:
             info = traceback.format_exception(*sys.exc_info())
             for i in info: 
                 sys.stderr.write(i)
 
+    def handleTimeout(self):
+        # Called every second by the SeisComP timer, flush once the interval has elapsed
+        if self.pending > 0 and time.time() - self.last_flush >= flush_interval:
+            self.flush()
+
+    # Write the stations changed since the last flush to the QC store, and the new values to the QC history
+    def flush(self):
+        try:
+            with metrics.span('qc_history_write'):
+                self.history.flush()
+        except:
+            info = traceback.format_exception(*sys.exc_info())
+            for i in info:
+                sys.stderr.write(i)
+        try:
+            with metrics.span('qc_store_write'):
+                self.store.upsert({staID: self.QC_dict[staID] for staID in self.dirty})
+        except:
+            info = traceback.format_exception(*sys.exc_info())
+            for i in info:
+                sys.stderr.write(i)
+            return
+        self.flush_count += 1
+        self.update_count += self.pending
+        now = time.time()
+        for received in self.dirty.values():
+            metrics.observe('scqcweb_listener_flush_lag_seconds', now - received)
+        metrics.inc('scqcweb_listener_flushes_total')
+        print("Flush %d: %d updates coalesced into %d stations (%d updates in total)" % (self.flush_count, self.pending, len(self.dirty), self.update_count))
+        self.dirty.clear()
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def done(self):
+        if self.pending > 0:
+            self.flush()
+        client.Application.done(self)
+
 def main():
     qc_dict = InventoryReader(len(sys.argv), sys.argv)
     qc_dict()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Queries and rollups of the system_stats table written by system_monitor.py
+
+Raw samples are averaged into 1-minute, hourly and daily rollup tables, each
+with its own retention, and range queries read from the coarsest table that
+still has enough points to fill the requested plot.
+"""
+
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+
+# Rollup levels as (table, bucket seconds, source table, bucket format)
+ROLLUPS = [('system_stats_1min', 60, 'system_stats', '%Y-%m-%d %H:%M:00'),
+           ('system_stats_1hour', 3600, 'system_stats_1min', '%Y-%m-%d %H:00:00'),
+           ('system_stats_1day', 86400, 'system_stats_1hour', '%Y-%m-%d 00:00:00')]
+
+# Default days of data kept per table, 0 keeps data forever
+RETENTION = {'system_stats': 14,
+             'system_stats_1min': 90,
+             'system_stats_1hour': 730,
+             'system_stats_1day': 0}
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+# Metric columns of system_stats, new mount points add columns over time
+def metric_columns(conn, table='system_stats'):
+    return [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table) if row[1] not in ['id', 'timestamp', 'samples']]
+
+# Create the timestamp index and rollup tables, adding any metric columns the rollups are missing
+def ensure_schema(conn):
+    columns = metric_columns(conn)
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS system_stats_timestamp ON system_stats (timestamp)")
+        for table, seconds, source, bucket in ROLLUPS:
+            conn.execute("CREATE TABLE IF NOT EXISTS %s (timestamp TEXT PRIMARY KEY, samples INTEGER)" % table)
+            existing = metric_columns(conn, table)
+            for column in columns:
+                if column not in existing:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s REAL" % (table, column))
+
+# Average new samples into the rollup tables
+# Each level restarts at its newest bucket, so a partly filled bucket is completed on the next run
+def rollup(conn):
+    ensure_schema(conn)
+    columns = metric_columns(conn)
+    for table, seconds, source, bucket in ROLLUPS:
+        start = conn.execute("SELECT MAX(timestamp) FROM %s" % table).fetchone()[0]
+        if start is None:
+            start = ''
+        if source == 'system_stats':
+            averages = ", ".join("AVG(%s)" % column for column in columns)
+            samples = "COUNT(*)"
+        else:
+            # Weight coarser averages by the number of samples in each finer bucket
+            averages = ", ".join("SUM(%s * samples) / SUM(CASE WHEN %s IS NULL THEN 0 ELSE samples END)" % (column, column) for column in columns)
+            samples = "SUM(samples)"
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO %s (timestamp, samples, %s) "
+                         "SELECT strftime('%s', timestamp) AS bucket, %s, %s FROM %s "
+                         "WHERE timestamp >= ? GROUP BY bucket"
+                         % (table, ", ".join(columns), bucket, samples, averages, source), (start,))
+
+# Delete data older than the retention of each table, retention is a dictionary of table to days
+def prune(conn, retention=RETENTION):
+    now = datetime.now(timezone.utc)
+    with conn:
+        for table, days in retention.items():
+            if days > 0:
+                cutoff = (now - timedelta(days=days)).strftime(TIME_FORMAT)
+                conn.execute("DELETE FROM %s WHERE timestamp < ?" % table, (cutoff,))
+
+# Tables from finest to coarsest with the seconds per row, raw samples have no fixed spacing
+def resolutions():
+    return [('system_stats', 0)] + [(table, seconds) for table, seconds, source, bucket in ROLLUPS]
+
+# Read the metrics between start and end (TIME_FORMAT strings) from the coarsest table
+# that has at least min_points rows in the range and still holds data from start
+# Returns (table, column names, rows), the first column is the timestamp
+def query(conn, start, end, min_points):
+    span = (datetime.strptime(end, TIME_FORMAT) - datetime.strptime(start, TIME_FORMAT)).total_seconds()
+    tables = [table for table, seconds in resolutions() if table == 'system_stats' or (table_exists(conn, table) and seconds * min_points <= span)]
+    chosen = 'system_stats'
+    chosen_oldest = None
+    for table in reversed(tables):
+        oldest = conn.execute("SELECT MIN(timestamp) FROM %s" % table).fetchone()[0]
+        if oldest is not None and oldest <= start:
+            chosen = table
+            break
+        # No table reaches back to start so far, keep the one with the oldest data (the coarsest on ties)
+        if oldest is not None and (chosen_oldest is None or oldest < chosen_oldest):
+            chosen = table
+            chosen_oldest = oldest
+    columns = ['timestamp'] + metric_columns(conn, chosen)
+    rows = conn.execute("SELECT %s FROM %s WHERE timestamp >= ? AND timestamp <= ? ORDER BY timestamp"
+                        % (", ".join(columns), chosen), (start, end)).fetchall()
+    return chosen, columns, rows
+
+# Oldest and newest raw sample up to end, these change whenever the data query() returns for a range ending at end changes
+def version(conn, end):
+    return conn.execute("SELECT MIN(timestamp), MAX(timestamp) FROM system_stats WHERE timestamp <= ?", (end,)).fetchone()
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
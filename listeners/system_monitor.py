@@ -2,18 +2,47 @@
 """
 Created on Wed Jun  4 15:50:07 2025
 
+Run once (e.g. from cron) to log one sample, or with --daemon to keep sampling
+at a fixed interval and write samples to the database in batches.
+Samples are averaged into 1-minute, hourly and daily rollup tables after each
+write and old data is pruned per table (see stats_db.py).
+
 @author: nnovoa
 """
 
+import argparse
 import os
 import psutil
+import queue
+import re
+import signal
 import sqlite3
+import threading
+import time
+
+import stats_db
+
+from datetime import datetime, timezone
 
 db_path = os.path.join('/opt','scqcweb', 'listeners', 'system_monitor.db')
+# Mount points logged by default, each one is stored in a <name>_disk_usage column
+default_mounts = ['/', '/var', '/data', '/opt', '/home']
+
+# Column name of the disk usage of a mount point, / is stored as root_disk_usage
+# Every character that is not valid in a plain SQL column name becomes _, e.g. /mnt/data.1 is mnt_data_1_disk_usage
+def mount_column(mount):
+    name = re.sub('[^a-z0-9_]', '_', mount.strip('/').lower())
+    if name == '':
+        name = 'root'
+    elif name[0].isdigit():
+        name = 'mnt_' + name
+    return name + '_disk_usage'
 
 # Step 1: Set up SQLite database
-def setup_database():
-    conn = sqlite3.connect(db_path)
+def setup_database(mounts=default_mounts):
+    conn = sqlite3.connect(db_path, timeout=30)
+    # WAL lets the web app read while samples are written
+    conn.execute("PRAGMA journal_mode=WAL")
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS system_stats (
@@ -31,58 +60,150 @@ def setup_database():
             load_avg_15min REAL
         )
     """)
+    # Add columns for mount points that are not in the table yet
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(system_stats)")]
+    for mount in mounts:
+        column = mount_column(mount)
+        if column not in columns:
+            cursor.execute("ALTER TABLE system_stats ADD COLUMN %s REAL" % column)
+            columns.append(column)
     conn.commit()
+    stats_db.ensure_schema(conn)
     return conn
 
 # Step 2: Collect system stats using psutil
-def collect_system_stats():
-    # Get CPU usage percentage
-    cpu_percent = psutil.cpu_percent(interval=1)
-    #print(f"CPU Usage: {cpu_percent}%")
+# cpu_interval=None measures CPU usage since the previous call instead of blocking
+def collect_system_stats(mounts=default_mounts, cpu_interval=1):
+    stats = {'timestamp': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}
 
-    # Get CPU core count
-    #cpu_cores = psutil.cpu_count(logical=True)
-    #print(f"Logical CPU Cores: {cpu_cores}")
+    # Get CPU usage percentage
+    stats['cpu_percent'] = psutil.cpu_percent(interval=cpu_interval)
 
     # Get virtual memory details
-    memory_percent = psutil.virtual_memory().percent
-    #print(f"Total Memory: {memory.total / (1024 ** 3):.2f} GB")
-    #print(f"Available Memory: {memory.available / (1024 ** 3):.2f} GB")
-    #print(f"Memory Usage: {memory_percent}%")
+    stats['memory_percent'] = psutil.virtual_memory().percent
 
     # Get disk usage for the root directory and other partitions
-    root_disk_usage = psutil.disk_usage('/').percent
-    var_disk_usage = psutil.disk_usage('/var').percent
-    data_disk_usage = psutil.disk_usage('/data').percent
-    opt_disk_usage = psutil.disk_usage('/opt').percent
-    home_disk_usage = psutil.disk_usage('/home').percent
-    #print(f"Total Disk Space: {disk_usage.total / (1024 ** 3):.2f} GB")
-    #print(f"Used Disk Space: {disk_usage.used / (1024 ** 3):.2f} GB")
-    #print(f"Free Disk Space: {disk_usage.free / (1024 ** 3):.2f} GB")
-    #print(f"Disk Usage: {root_disk_usage}%")
+    for mount in mounts:
+        try:
+            stats[mount_column(mount)] = psutil.disk_usage(mount).percent
+        except OSError:
+            stats[mount_column(mount)] = None
 
     #1, 5, and 15 minutes
     load_avg = psutil.getloadavg()
-    #print(f"Load Average (1 min): {load_avg[0]}")
-    #print(f"Load Average (5 min): {load_avg[1]}")
-    #print(f"Load Average (15 min): {load_avg[2]}")
-    return cpu_percent, memory_percent, root_disk_usage, var_disk_usage, data_disk_usage, opt_disk_usage, home_disk_usage, load_avg[0], load_avg[1], load_avg[2]
+    stats['load_avg_1min'] = load_avg[0]
+    stats['load_avg_5min'] = load_avg[1]
+    stats['load_avg_15min'] = load_avg[2]
+    return stats
 
-# Step 3: Insert data into the database
-def insert_stats(conn, stats):
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO system_stats (timestamp, cpu_percent, memory_percent, root_disk_usage, var_disk_usage, data_disk_usage, opt_disk_usage, home_disk_usage, load_avg_1min, load_avg_5min, load_avg_15min)
-        VALUES (datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, stats)
-    conn.commit()
+# Step 3: Insert data into the database, all samples in one transaction
+def insert_stats(conn, samples):
+    if not samples:
+        return
+    columns = list(samples[0].keys())
+    sql = "INSERT INTO system_stats (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?" * len(columns)))
+    with conn:
+        conn.executemany(sql, [tuple(sample[column] for column in columns) for sample in samples])
+
+# Sample every interval seconds on a fixed schedule and hand the samples to the writer
+def sampler(samples, mounts, interval, stop):
+    # The first non-blocking CPU reading has nothing to compare with, so take it now
+    psutil.cpu_percent(interval=None)
+    next_time = time.monotonic() + interval
+    while not stop.wait(max(0, next_time - time.monotonic())):
+        samples.put(collect_system_stats(mounts, cpu_interval=None))
+        next_time += interval
+        # Skip missed samples instead of bursting after a stall
+        if next_time < time.monotonic():
+            next_time = time.monotonic() + interval
+
+# Update the rollup tables, pruning old data at most every prune_interval seconds
+def rollup_stats(conn, retention, last_prune=0, prune_interval=3600):
+    stats_db.rollup(conn)
+    if time.monotonic() - last_prune >= prune_interval:
+        stats_db.prune(conn, retention)
+        last_prune = time.monotonic()
+    return last_prune
+
+# Write buffered samples every flush_interval seconds, or sooner once batch_size samples are waiting
+# Once stopped, writing is tried stop_retries more times before the remaining samples are dropped
+def writer(samples, mounts, flush_interval, batch_size, retention, stop, stop_retries=5):
+    conn = setup_database(mounts)
+    try:
+        buffer = []
+        last_flush = time.monotonic()
+        last_prune = 0
+        retries = 0
+        while True:
+            try:
+                buffer.append(samples.get(timeout=1))
+            except queue.Empty:
+                pass
+            if len(buffer) >= batch_size or (buffer and time.monotonic() - last_flush >= flush_interval) or stop.is_set():
+                while not samples.empty():
+                    buffer.append(samples.get_nowait())
+                try:
+                    insert_stats(conn, buffer)
+                    buffer = []
+                    last_prune = rollup_stats(conn, retention, last_prune)
+                except sqlite3.Error as error:
+                    # Keep the samples and try again on the next flush
+                    print("Failed to write %d samples: %s" % (len(buffer), str(error)))
+                    if stop.is_set():
+                        retries += 1
+                last_flush = time.monotonic()
+            if stop.is_set() and samples.empty() and not buffer:
+                break
+            if retries > stop_retries:
+                print("Dropped %d samples from %s to %s after %d failed writes on stop" % (
+                    len(buffer), buffer[0]['timestamp'], buffer[-1]['timestamp'], retries))
+                break
+    finally:
+        conn.close()
+
+def run_daemon(mounts, interval, flush_interval, batch_size, retention):
+    stop = threading.Event()
+    samples = queue.Queue()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    write_thread = threading.Thread(target=writer, args=(samples, mounts, flush_interval, batch_size, retention, stop), name='writer')
+    write_thread.start()
+    sampler(samples, mounts, interval, stop)
+    write_thread.join()
+    print("Monitoring stopped.")
 
 # Step 4: Main loop to monitor and log stats
 def main():
-    conn = setup_database()
+    global db_path
+    parser = argparse.ArgumentParser(description='Log system statistics to the scqcweb system monitor database.')
+    parser.add_argument('--daemon', action='store_true', help='keep running and sample every --interval seconds')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between samples in daemon mode (default 10)')
+    parser.add_argument('--flush-interval', type=float, default=60, help='seconds between database writes in daemon mode (default 60)')
+    parser.add_argument('--batch-size', type=int, default=500, help='samples that force an early database write (default 500)')
+    parser.add_argument('--mounts', nargs='+', default=default_mounts, help='mount points to log disk usage for')
+    parser.add_argument('--db', default=db_path, help='path to the system monitor database')
+    parser.add_argument('--rollup', action='store_true', help='only update the rollup tables and prune old data, without sampling')
+    parser.add_argument('--keep-raw', type=int, default=stats_db.RETENTION['system_stats'], help='days of raw samples to keep, 0 keeps all (default %(default)s)')
+    parser.add_argument('--keep-1min', type=int, default=stats_db.RETENTION['system_stats_1min'], help='days of 1-minute averages to keep (default %(default)s)')
+    parser.add_argument('--keep-1hour', type=int, default=stats_db.RETENTION['system_stats_1hour'], help='days of hourly averages to keep (default %(default)s)')
+    parser.add_argument('--keep-1day', type=int, default=stats_db.RETENTION['system_stats_1day'], help='days of daily averages to keep (default %(default)s)')
+    args = parser.parse_args()
+    db_path = args.db
+    retention = {'system_stats': args.keep_raw,
+                 'system_stats_1min': args.keep_1min,
+                 'system_stats_1hour': args.keep_1hour,
+                 'system_stats_1day': args.keep_1day}
+
+    if args.daemon:
+        run_daemon(args.mounts, args.interval, args.flush_interval, args.batch_size, retention)
+        return
+
+    conn = setup_database(args.mounts)
     try:
-        stats = collect_system_stats()
-        insert_stats(conn, stats)
+        if not args.rollup:
+            stats = collect_system_stats(args.mounts)
+            insert_stats(conn, [stats])
+        rollup_stats(conn, retention)
         #print(f"Logged stats: {stats}")
     except KeyboardInterrupt:
         print("Monitoring stopped.")
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of rendered plot images shared by all gunicorn workers
+
+Images are stored as files in the cache directory and tracked in a small
+SQLite index, which is used for least-recently-used eviction once the cache
+grows past its size limit and to count which plots are requested most.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+
+class PlotCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.db')
+        os.makedirs(cache_dir, exist_ok=True)
+        conn = self.connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    filename TEXT,
+                    size INTEGER,
+                    last_access REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage (
+                    name TEXT PRIMARY KEY,
+                    hits INTEGER,
+                    last_used REAL
+                )
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def filename(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.bin'
+
+    # Return the cached bytes for key, or None if the key is not cached
+    def get(self, key):
+        path = os.path.join(self.cache_dir, self.filename(key))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        finally:
+            conn.close()
+        return data
+
+    # Return a dictionary of the cached bytes for those keys that are cached, updating access times once
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                with open(os.path.join(self.cache_dir, self.filename(key)), 'rb') as f:
+                    found[key] = f.read()
+            except FileNotFoundError:
+                pass
+        if found:
+            now = time.time()
+            conn = self.connect()
+            try:
+                with conn:
+                    conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+            finally:
+                conn.close()
+        return found
+
+    # Store bytes for key, then evict the least recently used entries above the size limit
+    def put(self, key, data):
+        filename = self.filename(key)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.cache_dir, filename))
+        except:
+            os.unlink(tmp_path)
+            raise
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO entries (key, filename, size, last_access) VALUES (?, ?, ?, ?)",
+                             (key, filename, len(data), time.time()))
+            self.evict(conn)
+        finally:
+            conn.close()
+
+    # Store several entries with one index update, items is a dictionary of key to bytes
+    def put_many(self, items):
+        if not items:
+            return
+        rows = []
+        now = time.time()
+        for key, data in items.items():
+            filename = self.filename(key)
+            fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, os.path.join(self.cache_dir, filename))
+            except:
+                os.unlink(tmp_path)
+                raise
+            rows.append((key, filename, len(data), now))
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO entries (key, filename, size, last_access) VALUES (?, ?, ?, ?)", rows)
+            self.evict(conn)
+        finally:
+            conn.close()
+
+    def evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, filename, size in conn.execute("SELECT key, filename, size FROM entries ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            removed.append((key, filename))
+            total -= size
+        with conn:
+            conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, filename in removed])
+        for key, filename in removed:
+            try:
+                os.unlink(os.path.join(self.cache_dir, filename))
+            except FileNotFoundError:
+                pass
+
+    # Count a request for a named plot, used to pick plots to pre-render
+    def record_use(self, name):
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO usage (name, hits, last_used) VALUES (?, 0, 0)", (name,))
+                conn.execute("UPDATE usage SET hits = hits + 1, last_used = ? WHERE name = ?", (time.time(), name))
+        finally:
+            conn.close()
+
+    # Most requested plot names used within the last max_age seconds
+    def most_used(self, count, max_age):
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT name FROM usage WHERE last_used > ? ORDER BY hits DESC LIMIT ?",
+                                (time.time() - max_age, count)).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in rows]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Process pool for rendering plots outside the web request threads
+
+Request threads submit a render job and wait for its result, so the matplotlib
+work of slow plots never runs inside the gunicorn worker itself. The number of
+queued and running jobs is bounded: a job submitted to a full pool fails right
+away with RenderBusy instead of piling up behind the others, and a batch of
+jobs is only submitted if the pool has room for all of them. Each job runs with
+an alarm in its render process, so a job running longer than the timeout is
+stopped and frees its process. A job still queued when its caller stops
+waiting is cancelled. Identical requests arriving while a job is queued or
+running share that job's result instead of rendering again.
+"""
+
+import math
+import multiprocessing
+import os
+import signal
+import threading
+
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from listeners import metrics
+
+class RenderError(Exception):
+    pass
+
+# Too many render jobs are queued
+class RenderBusy(RenderError):
+    pass
+
+# A render job did not finish within the timeout
+class RenderTimeout(RenderError):
+    pass
+
+def on_alarm(signum, frame):
+    raise RenderTimeout('Render job stopped after the timeout')
+
+# Run a render job in the render process, stopped by SIGALRM after timeout seconds
+def run_job(fn, timeout, args):
+    signal.signal(signal.SIGALRM, on_alarm)
+    signal.alarm(int(math.ceil(timeout)))
+    try:
+        return fn(*args)
+    finally:
+        signal.alarm(0)
+        # Render processes may sit idle for a long time, so share the job's spans right away
+        metrics.flush()
+
+class RenderPool:
+    # workers: render processes, queue: jobs that may wait for a free process, timeout: seconds per job
+    # preload: modules imported once by the fork server, so each new render process starts with them loaded
+    def __init__(self, workers=4, queue=32, timeout=60, preload=None):
+        self.workers = workers
+        self.queue = queue
+        self.timeout = timeout
+        self.preload = preload or []
+        self.pool = None
+        self.pool_pid = None
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.futures = set()
+
+    # Process pool of this web worker, created on first use and again after a fork or a crashed render process
+    def get_pool(self):
+        if self.pool is None or self.pool_pid != os.getpid():
+            context = multiprocessing.get_context('forkserver')
+            # Only has an effect before the fork server of this process is started
+            context.set_forkserver_preload(self.preload)
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            self.pool_pid = os.getpid()
+            self.jobs = {}
+            self.futures = set()
+        return self.pool
+
+    # Start fn(*args) in a render process and return its future
+    # Jobs with the same key (not None) share one future while it is queued or running
+    def submit(self, key, fn, *args):
+        return self.submit_many([(key, fn, args)])[0]
+
+    # Start a batch of (key, fn, args) jobs and return their futures
+    # Either every job is submitted or, when the pool has no room for all of them, none is and RenderBusy is raised
+    def submit_many(self, jobs):
+        started = []
+        with self.lock:
+            pool = self.get_pool()
+            new_keys = set(key for key, fn, args in jobs if key is not None and key not in self.jobs)
+            new = len(new_keys) + sum(1 for key, fn, args in jobs if key is None)
+            if new > 0 and len(self.futures) + new > self.workers + self.queue:
+                raise RenderBusy('%d render jobs are queued or running, %d more do not fit' % (len(self.futures), new))
+            futures = []
+            for key, fn, args in jobs:
+                if key is not None and key in self.jobs:
+                    futures.append(self.jobs[key])
+                    continue
+                try:
+                    future = pool.submit(run_job, fn, self.timeout, args)
+                except BrokenProcessPool:
+                    self.pool = None
+                    pool = self.get_pool()
+                    future = pool.submit(run_job, fn, self.timeout, args)
+                self.futures.add(future)
+                if key is not None:
+                    self.jobs[key] = future
+                futures.append(future)
+                started.append((key, future))
+        for key, future in started:
+            future.add_done_callback(lambda done, key=key: self.finished(key, done))
+        return futures
+
+    def finished(self, key, future):
+        with self.lock:
+            self.futures.discard(future)
+            if key is not None and self.jobs.get(key) is future:
+                del self.jobs[key]
+            # A render process died, start a new pool for the next job
+            if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool) and self.pool_pid == os.getpid():
+                self.pool = None
+
+    # Wait for the result of a submitted job
+    # A job that is still queued after timeout seconds is cancelled, a running job is stopped by its own alarm
+    def result(self, future):
+        with metrics.span('render_wait'):
+            try:
+                return future.result(timeout=self.timeout)
+            except TimeoutError:
+                # Dropped, so a job nobody waits for no longer holds a place in the queue
+                if future.cancel():
+                    raise RenderTimeout('Render job waited more than %d seconds for a render process' % self.timeout)
+            except CancelledError:
+                raise RenderTimeout('Render job was cancelled while queued')
+            return future.result()
+
+    # Submit a job and wait for its result
+    def run(self, key, fn, *args):
+        return self.result(self.submit(key, fn, *args))
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'queue': self.queue, 'pending': len(self.futures)}
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time viewer engine
+
+Keeps a rolling in-memory buffer of the most recent data of each watched
+channel, topped up by reading only the new data from the waveform source
+(the SDS archive, or any client with get_waveforms). Each channel is rendered
+at most once per interval to its own image file, and every viewer of that
+channel gets the same image. Concurrent requests wait for one render instead
+of starting their own, also across gunicorn workers through a file lock.
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from obspy import Stream, UTCDateTime
+
+from downsample import downsample
+
+# Pixel width of real-time plots
+RT_width = 1200
+
+class RTChannel:
+    def __init__(self, nslc):
+        self.nslc = nslc
+        self.stream = Stream()
+        self.last_end = None
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+class RTEngine:
+    def __init__(self, client, out_dir, window=600, interval=10, idle=300):
+        self.client = client
+        self.out_dir = out_dir
+        self.window = window
+        self.interval = interval
+        self.idle = idle
+        self.channels = {}
+        self.lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def filename(self, nslc):
+        return nslc.replace('/', '_') + '.png'
+
+    # Buffer of a channel, channels nobody watched for idle seconds are dropped
+    def channel(self, nslc):
+        now = time.time()
+        with self.lock:
+            for name in [name for name, ch in self.channels.items() if now - ch.last_used > self.idle]:
+                del self.channels[name]
+            ch = self.channels.get(nslc)
+            if ch is None:
+                ch = RTChannel(nslc)
+                self.channels[nslc] = ch
+            ch.last_used = now
+            return ch
+
+    # Read only the data that arrived since the last update and drop data older than the window
+    def update(self, ch):
+        now = UTCDateTime.now()
+        window_start = now - self.window
+        if ch.last_end is None or ch.last_end < window_start:
+            starttime = window_start
+        else:
+            starttime = ch.last_end
+        net, sta, loc, cha = ch.nslc.split('.')
+        new = self.client.get_waveforms(net, sta, loc, cha, starttime, now)
+        if len(new) > 0:
+            ch.stream += new
+            ch.stream.merge(method=1)
+            ch.last_end = max(tr.stats.endtime for tr in ch.stream)
+        ch.stream.trim(starttime=window_start)
+
+    # Matplotlib is imported when the first channel is drawn, not when the web worker starts
+    def draw(self, ch):
+        import matplotlib.pyplot as plt
+        from matplotlib.dates import DateFormatter
+        now = UTCDateTime.now()
+        fig, ax = plt.subplots(1, 1, figsize=(6, 2.5), layout="constrained", dpi=200)
+        for tr in ch.stream:
+            data = np.ma.filled(np.ma.asarray(tr.data, dtype=float), np.nan)
+            x, y = downsample(tr.times("matplotlib"), data, RT_width)
+            ax.plot(x, y, linestyle='-', color='b', linewidth=0.5)
+        ax.xaxis_date()
+        ax.set_xlim((now - self.window).matplotlib_date, now.matplotlib_date)
+        ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
+        ax.set_title(ch.nslc + ' - ' + now.strftime('%Y-%m-%d %H:%M:%S'), fontsize=8)
+        ax.grid(True, which='major', axis='both')
+        ax.tick_params(axis='both', labelsize=6)
+        return fig
+
+    # Write the plot to the channel's image file through a temporary file, so viewers never get a partial image
+    def write(self, ch, fig):
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', suffix='.png', dir=self.out_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                FigureCanvas(fig).print_png(f)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, os.path.join(self.out_dir, self.filename(ch.nslc)))
+        except:
+            os.unlink(tmp_path)
+            raise
+        finally:
+            plt.close(fig)
+
+    # Return the file name and modification time of an image of nslc no older than the interval
+    def image(self, nslc):
+        ch = self.channel(nslc)
+        path = os.path.join(self.out_dir, self.filename(nslc))
+        with ch.lock:
+            if self.is_fresh(path):
+                return self.filename(nslc), os.path.getmtime(path)
+            with open(path + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # Another worker may have rendered the channel while we waited
+                    if not self.is_fresh(path):
+                        self.update(ch)
+                        self.write(ch, self.draw(ch))
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return self.filename(nslc), os.path.getmtime(path)
+
+    def is_fresh(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) < self.interval
+        except FileNotFoundError:
+            return False
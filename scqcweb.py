@@ -7,32 +7,65 @@ Need to use with a listener(s)
 @author: nnovoa
 """
 
+import base64
+import click
+import collections
 import configparser
+import gc
+import gzip
+import hashlib
+import json
 import io
-import matplotlib.pyplot as plt
 import os
-import pandas as pd
-import pickle
+import re
 import sqlite3
-import subprocess
+import struct
+import sys
+import threading
 import time
 
-from datetime import datetime, timedelta
-from flask import Flask, jsonify, make_response, render_template, request, session, url_for
+from contextlib import contextmanager
+
+# Seconds taken by each start-up step of this process, see startup_report()
+# Matplotlib and the waveform client modules are only imported when first needed, or by preload()
+startup = collections.OrderedDict()
+startup_start = time.perf_counter()
+
+import numpy as np
+
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, g, jsonify, make_response, render_template, request, session, url_for
 from flask_session import Session
 from flask_wtf import FlaskForm
 #from logging.config import dictConfig
-from obspy.clients.filesystem.sds import Client as SDSClient
-from obspy.clients.fdsn import Client as FDSNClient
 from obspy import UTCDateTime
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.dates import DateFormatter, DayLocator, HourLocator
+from markupsafe import escape
 from wtforms import DateField, StringField, SelectField, SubmitField, TimeField
-from wtforms.validators import DataRequired, InputRequired, ValidationError
+from wtforms.validators import DataRequired, InputRequired, Optional, ValidationError
+
+from downsample import downsample, downsample_scatter
+from helicorder import draw_heli, heli_tiles
+from inventory_index import InventoryIndex
+from listeners import metrics, ppsd_catalog, qc_history, qc_store, stats_db
+from plot_cache import PlotCache
+from render_pool import RenderError, RenderPool
+from rt_engine import RTEngine
+from waveform_cache import WaveformCache
+
+startup['imports'] = time.perf_counter() - startup_start
 
-# Read config.ini file and define variables
+# Time a start-up step, the time is added to the step's total
+@contextmanager
+def startup_step(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup[name] = startup.get(name, 0.0) + time.perf_counter() - start
+
+# Read config.ini file and define variables, SCQCWEB_CONFIG may point to another file (e.g. for benchmarks)
 config = configparser.ConfigParser()
-config.read('config.ini')
+config.read(os.environ.get('SCQCWEB_CONFIG', 'config.ini'))
 # Access values from the configuration file
 secret_key = config.get('Flask', 'secret_key')
 SESSION_COOKIE_SECURE = config.getboolean('Flask', 'SESSION_COOKIE_SECURE')
@@ -41,11 +74,33 @@ SESSION_TYPE = config.get('Flask', 'SESSION_TYPE')
 SESSION_FILE_DIR = config.get('Flask', 'SESSION_FILE_DIR')
 source = config.get('Source', 'source_ini')
 if source == 'SDS':
+    from obspy.clients.filesystem.sds import Client as SDSClient
     SDS_path = os.path.normpath(config.get('Paths', 'path_SDS'))
     client = SDSClient(SDS_path)
 elif source == 'FDSNWS':
+    # The FDSN client modules are only needed, and only imported, with this source
+    from fdsn_cache import CachedFDSNClient
     FDSNWS = config.get('Paths', 'path_FDSNWS')
-    client = FDSNClient(FDSNWS)
+    # Waveforms are cached on local disk in SDS layout and only missing spans are fetched
+    client = CachedFDSNClient(FDSNWS, os.path.join(os.path.dirname(__file__), config.get('Cache', 'fdsn_cache_dir', fallback='fdsn_cache')),
+                              workers=config.getint('Cache', 'fdsn_workers', fallback=8),
+                              latency=config.getint('Cache', 'fdsn_latency', fallback=120),
+                              refresh=config.getint('Cache', 'fdsn_refresh', fallback=10),
+                              keep_days=config.getint('Cache', 'fdsn_cache_days', fallback=60),
+                              network=config.get('Paths', 'FDSNWS_network', fallback='') or '*',
+                              station=config.get('Paths', 'FDSNWS_station', fallback='') or '*')
+QC_backend = config.get('Listener', 'qc_store', fallback='sqlite')
+# Render processes of each web worker, render jobs that may wait for a process, and seconds per render job
+render_workers = config.getint('Render', 'render_workers', fallback=config.getint('Render', 'soh_workers', fallback=4))
+render_queue = config.getint('Render', 'render_queue', fallback=32)
+render_timeout = config.getint('Render', 'render_timeout', fallback=60)
+# Seconds browsers and proxies may reuse plots addressed by their URL before checking them again
+http_max_age = config.getint('Cache', 'http_max_age', fallback=60)
+# Folder where each process shares its timing spans and counters for /metrics, empty keeps them per process
+metrics_dir = config.get('Metrics', 'metrics_dir', fallback='metrics')
+# Add a Server-Timing header with the spans of each request
+server_timing = config.getboolean('Metrics', 'server_timing', fallback=False)
+startup['config'] = time.perf_counter() - startup_start - startup['imports']
 
 #Create the Flask App
 app = Flask(__name__)
@@ -63,9 +118,48 @@ Session(app)
 # Define global variables
 app_path = os.path.dirname(__file__)
 
+metrics.configure(os.path.join(app_path, metrics_dir) if metrics_dir else None,
+                  flush_interval=config.getint('Metrics', 'flush_interval', fallback=5))
+
 # Specify path to listener files
-QC_path = os.path.join(app_path,'listeners', 'QC_dictionary.pkl')
-systemdb_path = os.path.join(app_path, 'listeners', 'system_monitor.db')
+QC = qc_store.open_store(QC_backend, config.get('Listener', 'qc_path', fallback='') or None)
+
+# History of the QC values of every channel, written by the listener
+QC_history = qc_history.QCHistory(config.get('Listener', 'qc_history_dir', fallback='') or qc_history.QC_history_path)
+
+# Decoded archive day files, shared by the SOH, helicorder and real-time views
+waveforms = WaveformCache(client, config.getint('Cache', 'waveform_cache_mb', fallback=256) * 1024 * 1024,
+                          shm_dir=config.get('Cache', 'waveform_shm_dir', fallback='') or None)
+
+# Plots are rendered in separate processes, request threads only wait for the images
+# New render processes are forked from a server that has already imported this module and matplotlib
+renders = RenderPool(render_workers, render_queue, render_timeout, preload=['matplotlib.pyplot', __name__])
+
+# On-disk cache of rendered SOH plots, shared by all workers
+soh_cache_dir = os.path.join(app_path, config.get('Cache', 'soh_cache_dir', fallback='soh_cache'))
+soh_cache_mb = config.getint('Cache', 'soh_cache_mb', fallback=500)
+soh_cache = PlotCache(soh_cache_dir, soh_cache_mb * 1024 * 1024)
+
+# On-disk cache of one-hour helicorder tiles, shared by all workers
+heli_cache_dir = os.path.join(app_path, config.get('Cache', 'heli_cache_dir', fallback='heli_cache'))
+heli_cache_mb = config.getint('Cache', 'heli_cache_mb', fallback=500)
+heli_cache = PlotCache(heli_cache_dir, heli_cache_mb * 1024 * 1024)
+
+# Rolling buffers and shared images of the channels watched on the real-time page
+rt_engine = RTEngine(waveforms, os.path.join(app_path, 'static', 'images', 'rt'),
+                     window=config.getint('Render', 'rt_window', fallback=600),
+                     interval=config.getint('Render', 'rt_interval', fallback=10))
+
+# Station and channel lists used by the forms, shared by all workers and refreshed in the background
+inventory = InventoryIndex(client, source, os.path.join(soh_cache_dir, 'inventory_index.json'),
+                           ttl=config.getint('Cache', 'inventory_ttl', fallback=3600),
+                           check_interval=config.getint('Cache', 'inventory_check', fallback=60),
+                           sds_path=SDS_path if source == 'SDS' else None)
+systemdb_path = config.get('Paths', 'path_system_monitor', fallback='') or os.path.join(app_path, 'listeners', 'system_monitor.db')
+# Catalogue of PPSD plots, written by listeners/SDS_ppsd.py
+ppsd_catalog_path = config.get('Paths', 'path_ppsd_catalog', fallback='') or os.path.join(app_path, 'listeners', 'ppsd_catalog.db')
+# Number of PPSD plots shown per page
+PPSD_page_size = 24
 
 # Dictionary(Lookup table) for SOH abbreviations
 SOH_desc = {'dcz': 'HNZ DC Offset',
@@ -99,55 +193,278 @@ SOH_desc = {'dcz': 'HNZ DC Offset',
 QC_headers = ['Latency (s)', 'Delay (s)', 'Timing Quality', 'Gaps Count', 'Overlaps Count', 'Availability (%)']
 
 # Get sysmtem monitoring stats from sqlite database
+# Reads the coarsest rollup that still gives at least one point per pixel of the plot
+# Returns the sample times as datetime64 and a dictionary of column name to float array, missing values are NaN
 def read_stats(sdate2, edate2):
     conn = sqlite3.connect(systemdb_path)
-    cursor = conn.cursor()
-    # Select data from the database
-    select_str = "SELECT * FROM system_stats WHERE timestamp BETWEEN '" + sdate2 + "' AND '" + edate2 +"'"
-    cursor.execute(select_str)
-    rows = cursor.fetchall()  # Fetch all rows from the query
-    # Close the connection
-    conn.close()
-    return rows
-
-#Collect SOH data and create matplotlib figure
-def soh_plot(sta_id, soh_id, sta_time):
-    ns_id = sta_id.split(".")
+    try:
+        with metrics.span('sqlite_query'):
+            table, columns, rows = stats_db.query(conn, sdate2, edate2, server_width)
+    finally:
+        conn.close()
+    times = np.array([row[0] for row in rows], dtype='datetime64[s]')
+    values = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(columns) - 1)
+    return times, {column: values[:, i] for i, column in enumerate(columns[1:])}
+
+# Width in pixels of SOH and server plots, series are downsampled to this many columns
+SOH_width = 1000
+server_width = 1200
+
+# SOH channels plotted as points instead of lines
+SOH_scatter = ['rmz', 'rmn', 'rm2', 'rme', 'rm1', 'mxz', 'mxn', 'mx2', 'mxe', 'mx1']
+
+# Height in pixels of the plot area of SOH panels, scatter channels keep one point per pixel cell
+SOH_height = 300
+
+# Downsample one SOH series to width pixel columns for plotting
+# Scatter channels keep one point per pixel cell, as the envelope would drop the point cloud inside each column
+def soh_downsample(soh_id, x, y, width):
+    if soh_id in SOH_scatter:
+        return downsample_scatter(x, y, width, SOH_height)
+    return downsample(x, y, width)
+
+# NET.STA given in URLs, without wildcards so a request never reads more than one station
+STATION_pattern = re.compile(r'^[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+$')
+
+# Start and end dates of SOH plots, the window always ends at the start of the current UTC day
+def soh_window(sta_time):
     end_time = UTCDateTime.now().date
     soh_time = end_time - timedelta(days=sta_time)
-    st = client.get_waveforms(ns_id[0], ns_id[1], "*", soh_id, UTCDateTime(soh_time), UTCDateTime(end_time))
-    if len(st) > 0:
-        fig, ax = plt.subplots(1, 1, figsize=(5, 1.5), layout="constrained", dpi=200)
-        for tr in st:
-            if soh_id in ['rmz', 'rmn', 'rm2', 'rme', 'rm1', 'mxz', 'mxn', 'mx2', 'mxe', 'mx1']:
-                ax.scatter(tr.times("matplotlib"), tr.data, s=2, color='g', label=ns_id)
-            else:
-                ax.plot(tr.times("matplotlib"), tr.data, linestyle='-', color='g', label=ns_id)
-        if soh_id in ['dsk', 'lcq']:
-            ax.set_ylim(0, 105)
-        ax.xaxis.set_major_formatter(DateFormatter('%b %d %Y'))
-        ax.xaxis.set_major_locator(DayLocator(interval=2))
-        if soh_id in SOH_desc.keys():
-            description = SOH_desc.get(soh_id)
-            title = description + ' - ' + ns_id[0] + '.' + ns_id[1]
-            ax.set_title(title)
-        ax.grid(True, which='major', axis='both')
-        #ax.tick_params(axis='x', labelrotation=45)
-        ax.tick_params(axis='both', labelsize=6)
-        ax.set_xlim(soh_time, end_time)
-        return fig, ax
+    return soh_time, end_time
+
+# Read every SOH channel of a station with a single archive request
+# SOH channels are lower case in the SDS archive, so one glob covers them all
+def soh_channels():
+    if source == 'SDS':
+        return '[a-z]??'
+    return ','.join(SOH_desc.keys())
+
+def get_soh_stream(net, sta, soh_time, end_time):
+    st = waveforms.get_waveforms(net, sta, "*", soh_channels(), UTCDateTime(soh_time), UTCDateTime(end_time))
+    return st
+
+# Split a stream into plain (times, data) arrays per SOH channel, which can be sent to worker processes
+def soh_traces(st):
+    traces = {}
+    for tr in st:
+        if tr.stats.channel in SOH_desc:
+            traces.setdefault(tr.stats.channel, []).append(soh_downsample(tr.stats.channel, tr.times("matplotlib"), tr.data, SOH_width))
+    return traces
+
+# Downsampled SOH series per channel for drawing in the browser
+# Returns a dictionary of SOH channel to (epoch times, values), traces are separated by NaN to break lines
+def soh_series(st, width):
+    series = {}
+    for tr in st:
+        if tr.stats.channel in SOH_desc:
+            times, data = soh_downsample(tr.stats.channel, tr.times("timestamp"), tr.data.astype(np.float32), width)
+            if tr.stats.channel in series:
+                prev_times, prev_data = series[tr.stats.channel]
+                times = np.concatenate((prev_times, [np.nan], times))
+                data = np.concatenate((prev_data, [np.nan], data))
+            series[tr.stats.channel] = (times, data)
+    return series
+
+# Pack SOH series into a binary payload of typed arrays:
+# 4-byte little-endian header length, JSON header padded to 8 bytes, then per channel
+# n float64 epoch times followed by n float32 values (padded to 8 bytes)
+def pack_series(header, series):
+    channels = []
+    body = io.BytesIO()
+    for soh_id, (times, data) in series.items():
+        offset = body.tell()
+        body.write(np.asarray(times, dtype='<f8').tobytes())
+        body.write(np.asarray(data, dtype='<f4').tobytes())
+        body.write(b'\0' * (-body.tell() % 8))
+        channels.append({'channel': soh_id, 'description': SOH_desc[soh_id], 'n': len(times), 'offset': offset})
+    header = dict(header, channels=channels)
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(header_bytes) + 4) % 8)
+    return struct.pack('<I', len(header_bytes)) + header_bytes + body.getvalue()
+
+# Return a response, gzip compressed when the browser accepts it
+def compressed_response(data, mimetype):
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = make_response(gzip.compress(data, compresslevel=5))
+        response.headers['Content-Encoding'] = 'gzip'
     else:
-        return None, None
-
-# Create image from matplotlib figure and return it as a response
-def fig2resp(fig):
-    canvas = FigureCanvas(fig)
-    output = io.BytesIO()
-    canvas.print_png(output)
-    response = make_response(output.getvalue())
+        response = make_response(data)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.mimetype = mimetype
+    return response
+
+# Time every request, and keep its spans for the Server-Timing header when enabled
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    if server_timing:
+        metrics.start_trace()
+
+@app.after_request
+def record_timing(response):
+    if 'request_start' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'none'
+    metrics.observe('scqcweb_request_seconds', seconds, endpoint=endpoint)
+    metrics.inc('scqcweb_requests_total', endpoint=endpoint, status=str(response.status_code))
+    if server_timing:
+        spans = collections.OrderedDict()
+        for name, span_seconds in metrics.end_trace():
+            spans[name] = spans.get(name, 0.0) + span_seconds
+        spans['total'] = seconds
+        response.headers['Server-Timing'] = ', '.join('%s;dur=%.1f' % (name, span_seconds * 1000) for name, span_seconds in spans.items())
+    return response
+
+# Responses smaller than this are not worth compressing
+compress_min_bytes = 500
+
+# Compress HTML and JSON responses that were not compressed by the route itself
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in ['text/html', 'application/json']
+            or 'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    data = response.get_data()
+    if len(data) < compress_min_bytes:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# ETag of a response from the request parameters and the version of its data
+# ETags are weak because the same content may be sent gzip compressed or not
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+# Add the validators to a response, last_modified is epoch seconds or None
+# Plots addressed by their URL may be reused for max_age seconds, others are checked on every view
+def set_validators(response, etag, last_modified, max_age=0):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = datetime.fromtimestamp(int(last_modified), timezone.utc)
+    if max_age > 0:
+        response.headers['Cache-Control'] = 'private, max-age=%d' % max_age
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Return a 304 response when the browser's copy is still valid, None when the response must be built
+# If-None-Match takes precedence over If-Modified-Since
+def not_modified(etag, last_modified, max_age=0):
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since is not None:
+        fresh = int(last_modified) <= request.if_modified_since.timestamp()
+    else:
+        fresh = False
+    if fresh:
+        return set_validators(make_response('', 304), etag, last_modified, max_age)
+    return None
+
+# Response with PNG image bytes and its validators
+def png_response(image, etag, last_modified, max_age=0):
+    response = make_response(image)
     response.mimetype = 'image/png'
+    return set_validators(response, etag, last_modified, max_age)
+
+# Validators of an SOH plot, which like its cache entry only changes with the UTC day
+# The key holds the window end date, so neither the archive nor the FDSN client is touched
+def soh_validators(key, end_time):
+    return make_etag(key), UTCDateTime(end_time).timestamp
+
+# Draw one SOH channel into a new matplotlib figure
+def draw_soh(sta_id, soh_id, traces, soh_time, end_time):
+    with metrics.span('figure'):
+        return build_soh(sta_id, soh_id, traces, soh_time, end_time)
+
+def build_soh(sta_id, soh_id, traces, soh_time, end_time):
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import DateFormatter, DayLocator
+    ns_id = sta_id.split(".")
+    fig, ax = plt.subplots(1, 1, figsize=(5, 1.5), layout="constrained", dpi=200)
+    for times, data in traces:
+        if soh_id in SOH_scatter:
+            ax.scatter(times, data, s=2, color='g', label=sta_id)
+        else:
+            ax.plot(times, data, linestyle='-', color='g', label=sta_id)
+    if soh_id in ['dsk', 'lcq']:
+        ax.set_ylim(0, 105)
+    ax.xaxis.set_major_formatter(DateFormatter('%b %d %Y'))
+    ax.xaxis.set_major_locator(DayLocator(interval=2))
+    if soh_id in SOH_desc.keys():
+        description = SOH_desc.get(soh_id)
+        title = description + ' - ' + ns_id[0] + '.' + ns_id[1]
+        ax.set_title(title)
+    ax.grid(True, which='major', axis='both')
+    #ax.tick_params(axis='x', labelrotation=45)
+    ax.tick_params(axis='both', labelsize=6)
+    ax.set_xlim(soh_time, end_time)
+    return fig, ax
+
+# Collect the downsampled SOH data of one channel, an empty list if there is no data
+# Archive reads stay in the web workers, so only their waveform cache holds decoded files
+def soh_plot_traces(sta_id, soh_id, soh_time, end_time):
+    ns_id = sta_id.split(".")
+    st = waveforms.get_waveforms(ns_id[0], ns_id[1], "*", soh_id, UTCDateTime(soh_time), UTCDateTime(end_time))
+    return [soh_downsample(soh_id, tr.times("matplotlib"), tr.data, SOH_width) for tr in st]
+
+# Render one SOH panel to PNG bytes, runs in the render processes
+def render_soh_panel(sta_id, soh_id, traces, soh_time, end_time):
+    fig, ax = draw_soh(sta_id, soh_id, traces, soh_time, end_time)
+    return fig2png(fig)
+
+# Cache key of an SOH plot, plots only change when the UTC day changes
+def soh_key(sta_id, soh_id, sta_time, end_time):
+    return 'soh/%s/%s/%d/%s' % (sta_id, soh_id, sta_time, end_time.isoformat())
+
+# Read all SOH channels of a station once and render the panels in parallel render jobs
+# The jobs are submitted together or not at all, so a busy pool does not leave a station view half rendered
+# Returns a list of (SOH channel, PNG bytes) in the order of SOH_desc
+def soh_panels(sta_id, sta_time):
+    ns_id = sta_id.split(".")
+    soh_time, end_time = soh_window(sta_time)
+    # Use the cached panels when every panel of today's window is cached
+    cached_ids = soh_cache.get(soh_key(sta_id, 'channels', sta_time, end_time))
+    if cached_ids is not None:
+        soh_ids = json.loads(cached_ids)
+        images = [soh_cache.get(soh_key(sta_id, soh_id, sta_time, end_time)) for soh_id in soh_ids]
+        if None not in images:
+            return list(zip(soh_ids, images))
+    st = get_soh_stream(ns_id[0], ns_id[1], soh_time, end_time)
+    traces = soh_traces(st)
+    soh_ids = [soh_id for soh_id in SOH_desc if soh_id in traces]
+    futures = renders.submit_many([(soh_key(sta_id, soh_id, sta_time, end_time), render_soh_panel,
+                                    (sta_id, soh_id, traces[soh_id], soh_time, end_time)) for soh_id in soh_ids])
+    panels = [(soh_id, renders.result(future)) for soh_id, future in zip(soh_ids, futures)]
+    for soh_id, image in panels:
+        soh_cache.put(soh_key(sta_id, soh_id, sta_time, end_time), image)
+    soh_cache.put(soh_key(sta_id, 'channels', sta_time, end_time), json.dumps(soh_ids).encode('utf-8'))
+    return panels
+
+# Stack PNG panels of the same width into one image
+def stack_png(images):
+    import matplotlib.image as mpimg
+    import matplotlib.pyplot as plt
+    with metrics.span('png_encode'):
+        panels = [mpimg.imread(io.BytesIO(image), format='png') for image in images]
+        output = io.BytesIO()
+        plt.imsave(output, np.concatenate(panels, axis=0), format='png')
+    return output.getvalue()
+
+# Create PNG image bytes from matplotlib figure
+def fig2png(fig):
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    with metrics.span('png_encode'):
+        canvas = FigureCanvas(fig)
+        output = io.BytesIO()
+        canvas.print_png(output)
     plt.close(fig)  # Close the figure to free memory
-    return response
+    return output.getvalue()
 
 # For truncating latencies
 def truncate(n, decimals=0):
@@ -203,6 +520,180 @@ def count_color(val):
 		count_color = '#F97979'
 	return 'background-color: %s' % count_color
 
+# Color function for each QC column, in the same order as QC_headers
+QC_colors = [cell_color, cell_color, timing_color, count_color, count_color, availability_color]
+
+# Rendered network table, rebuilt only when the QC store version changes
+table_cache = {'version': None, 'html': None, 'updated': None}
+# Rendered rows, NET.STA -> (QC values, row html)
+row_cache = {}
+table_lock = threading.Lock()
+
+def format_value(val):
+    if val is None:
+        return ''
+    return '%.1f' % val
+
+def render_row(sta_id, values):
+    cells = ''.join('<td style="%s">%s</td>' % (color(val), format_value(val)) for color, val in zip(QC_colors, values))
+    return '<tr id="%s"><th>%s</th>%s</tr>' % (escape(sta_id), escape(sta_id), cells)
+
+# Build the network table HTML, re-rendering only rows whose values changed
+def render_table(QC_dict):
+    rows = []
+    for sta_id in sorted(QC_dict):
+        values = tuple(QC_dict[sta_id])
+        cached = row_cache.get(sta_id)
+        if cached is None or cached[0] != values:
+            cached = (values, render_row(sta_id, values))
+            row_cache[sta_id] = cached
+        rows.append(cached[1])
+    # Forget stations that were removed from the store
+    for sta_id in set(row_cache) - set(QC_dict):
+        del row_cache[sta_id]
+    header = ''.join('<th>%s</th>' % escape(h) for h in QC_headers)
+    return '<table class="data qc"><thead><tr><th></th>%s</tr></thead><tbody>%s</tbody></table>' % (header, ''.join(rows))
+
+def qc_version():
+    with metrics.span('qc_store_version'):
+        return QC.version()
+
+# Return the cached network table and update time, rendering it if the QC store changed
+def network_table():
+    version = qc_version()
+    if table_cache['version'] == version:
+        return table_cache['html'], table_cache['updated']
+    with table_lock:
+        # Another request may have rendered this version while we waited
+        if table_cache['version'] != version:
+            version = qc_version()
+            with metrics.span('qc_store_load'):
+                QC_dict = QC.load()
+            umtime = QC.last_update()
+            if umtime is not None:
+                ultime = datetime.fromtimestamp(umtime).strftime('%Y-%m-%d %H:%M:%S')
+            else:
+                ultime = 'No QC updates received yet'
+            table_cache['html'] = render_table(QC_dict)
+            table_cache['updated'] = ultime
+            table_cache['version'] = version
+        return table_cache['html'], table_cache['updated']
+
+# Server-Sent Events of changed network table rows
+# One thread per worker polls the QC store and wakes all connected viewers when rows change.
+# Events are identified by the QC store version they lead to, so a viewer resumes from the
+# version of its page or from Last-Event-ID, whichever worker serves it. Each open stream holds
+# a request thread, so at most max_streams are open per worker and other viewers poll changes_since().
+class QCEvents:
+    def __init__(self, poll_interval=1.0, keepalive=15, max_streams=8):
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.max_streams = max_streams
+        self.streams = 0
+        self.condition = threading.Condition()
+        # QC store version of the last published rows, None until the first poll
+        self.version = None
+        # Recent events as (version before, version after, JSON payload)
+        self.events = collections.deque(maxlen=100)
+        self.sent_values = None
+        self.thread_pid = None
+
+    # Start the poll thread in this process, done on first use so it also runs after gunicorn forks
+    def start(self):
+        with self.condition:
+            if self.thread_pid != os.getpid():
+                self.thread_pid = os.getpid()
+                threading.Thread(target=self.poll_loop, name='qc-events', daemon=True).start()
+
+    def poll_loop(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as error:
+                app.logger.error("Failed to poll QC store: %s", error)
+            time.sleep(self.poll_interval)
+
+    # Publish the rows whose values changed since the last event
+    def poll(self):
+        table, ultime = network_table()
+        with table_lock:
+            version = table_cache['version']
+            values = {sta_id: cached[0] for sta_id, cached in row_cache.items()}
+            if self.sent_values is None:
+                self.sent_values = values
+                with self.condition:
+                    self.version = version
+                return
+            changed = {sta_id: row_cache[sta_id][1] for sta_id, val in values.items() if self.sent_values.get(sta_id) != val}
+            removed = [sta_id for sta_id in self.sent_values if sta_id not in values]
+        if not changed and not removed:
+            return
+        self.sent_values = values
+        payload = json.dumps({'updated': ultime, 'rows': changed, 'removed': removed})
+        with self.condition:
+            self.events.append((self.version, version, payload))
+            self.version = version
+            self.condition.notify_all()
+
+    # Events after QC store version since, as a list of (version, payload)
+    # Returns None when they are no longer kept, or since is older than this worker's first poll, so the page must be reloaded
+    # Must be called holding the condition
+    def events_since(self, since):
+        events = [event for event in self.events if event[1] > since]
+        if self.version is None or self.version <= since:
+            return []
+        if not events or events[0][0] > since:
+            return None
+        return [(after, payload) for before, after, payload in events]
+
+    # Events after version since for viewers that poll, as (current version, list of payloads or None to reload)
+    def changes_since(self, since):
+        self.start()
+        with self.condition:
+            if since is None:
+                return self.version, []
+            events = self.events_since(since)
+            return self.version, None if events is None else [payload for version, payload in events]
+
+    # Take a stream slot of this worker, False when max_streams are open
+    def acquire(self):
+        with self.condition:
+            if self.streams >= self.max_streams:
+                return False
+            self.streams += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.streams -= 1
+
+    # Generator of the event stream of one viewer, starting after QC store version since (None for the current version)
+    def stream(self, since=None):
+        self.start()
+        last = since
+        while True:
+            with self.condition:
+                if last is None:
+                    last = self.version
+                self.condition.wait_for(lambda: self.version is not None and (last is None or self.version > last), timeout=self.keepalive)
+                events = self.events_since(last) if last is not None else []
+                if self.version is not None and (last is None or self.version > last):
+                    last = self.version
+            # Viewers that fell further behind than the kept events reload the whole table
+            if events is None:
+                yield 'event: reload\ndata: {}\n\n'
+                return
+            elif events:
+                for version, payload in events:
+                    yield 'id: %d\nevent: rows\ndata: %s\n\n' % (version, payload)
+            else:
+                yield ': keepalive\n\n'
+
+qc_events = QCEvents(poll_interval=config.getfloat('Render', 'qc_poll_interval', fallback=1.0),
+                     max_streams=config.getint('Render', 'qc_stream_max', fallback=8))
+# Seconds between requests of viewers polling for changed rows when no stream slot is free
+qc_fallback_poll = config.getint('Render', 'qc_fallback_poll', fallback=10)
+
 # Create forms to use for various web pages
 class StationForm(FlaskForm):
     station = SelectField('Station', validators=[InputRequired()])
@@ -211,6 +702,9 @@ class StationForm(FlaskForm):
 
 class PPSDForm(FlaskForm):
     PPSDstation = SelectField('Station', validators=[InputRequired()])
+    PPSDsdate = DateField('From (UTC):', format='%Y-%m-%d', validators=[Optional()])
+    PPSDedate = DateField('To (UTC):', format='%Y-%m-%d', validators=[Optional()])
+    PPSDperiod = SelectField('Period', choices=[('0', 'All'), ('1', 'Daily'), ('7', '7 days'), ('30', '30 days')], default='0')
     submit = SubmitField('Submit')
 
 class HeliForm(FlaskForm):
@@ -225,42 +719,67 @@ class RTForm(FlaskForm):
     rt_channel = SelectField('Specify Channel:', validators=[DataRequired()])
 
 class ServerForm(FlaskForm):
-    sdate2 = DateField('Specify Start Date (UTC):', default=(UTCDateTime.now().date-timedelta(days=30)), format='%Y-%m-%d', validators=[DataRequired()])
-    edate2 = DateField('Specify End Date (UTC):', default=UTCDateTime.now().date, format='%Y-%m-%d', validators=[DataRequired()])
+    # Defaults are evaluated per form, not once when the module is imported
+    sdate2 = DateField('Specify Start Date (UTC):', default=lambda: UTCDateTime.now().date - timedelta(days=30), format='%Y-%m-%d', validators=[DataRequired()])
+    edate2 = DateField('Specify End Date (UTC):', default=lambda: UTCDateTime.now().date, format='%Y-%m-%d', validators=[DataRequired()])
     submit = SubmitField('Submit')
 
+# Station and number of days selected on the station page
+sta_id = None
+sta_time = 0
+
 # Home page (Network page)
 @app.route('/')
 def index():
     try:
-        with open(QC_path, 'rb') as f:
-            QC_dict = pickle.load(f)
-        umtime = os.path.getmtime(QC_path)
-        ultime = datetime.fromtimestamp(umtime).strftime('%Y-%m-%d %H:%M:%S')
-        #app.logger.info(SOH_dict)
-        style_td = dict(selector="td", props=[('font-size', '10pt'),('border-style', 'solid')])
-        style_th = dict(selector="th", props=[('font-size', '12pt'),('border-style', 'solid')])
-        df = pd.DataFrame.from_dict(QC_dict, orient='index', columns=QC_headers)
-        df = df.sort_index(axis = 0)
-        df = df.style.map(cell_color, subset=pd.IndexSlice[:, ['Latency (s)', 'Delay (s)']])\
-            .map(timing_color, subset=pd.IndexSlice[:, ['Timing Quality']])\
-    		.map(count_color, subset=pd.IndexSlice[:, ['Gaps Count', 'Overlaps Count']])\
-    		.map(availability_color, subset=pd.IndexSlice[:, ['Availability (%)']])\
-    		.set_properties(**{'text-align': 'center','border-collapse' : 'collapse'})\
-    		.set_table_styles([style_td, style_th])\
-    		.format(precision=1)
-        return render_template('network.html', tables=[df.to_html(classes='data', header="true")], updated=ultime)
+        # The page only changes with the QC store, so a browser with the current version gets a 304
+        version = qc_version()
+        etag = make_etag('index', version)
+        response = not_modified(etag, None)
+        if response is not None:
+            return response
+        table, ultime = network_table()
+        # The table may be newer than version, updates are then sent again, which does no harm
+        page = render_template('network.html', tables=[table], updated=ultime, version=version, poll_seconds=qc_fallback_poll)
+        return set_validators(make_response(page), etag, None)
     except:
-        return render_template('network.html', tables=[], updated='No QC dictionary found')
+        return render_template('network.html', tables=[], updated='No QC dictionary found', version=None, poll_seconds=qc_fallback_poll)
+
+# QC store version given as Last-Event-ID or ?version=, None if missing or invalid
+def event_version():
+    try:
+        return int(request.headers.get('Last-Event-ID') or request.args.get('version'))
+    except (TypeError, ValueError):
+        return None
+
+# Stream of changed network table rows, used by network.html to update the table in place
+# When the worker has no free stream slot, the page polls /api/qc_events instead
+@app.route('/stream/qc')
+def stream_qc():
+    if not qc_events.acquire():
+        return ('Too many open streams', 503, {'Retry-After': str(qc_fallback_poll)})
+    response = Response(qc_events.stream(event_version()), mimetype='text/event-stream')
+    response.call_on_close(qc_events.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop reverse proxies such as nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Changed network table rows since ?version=, for viewers that poll instead of streaming
+# Versions are sent as strings, as QC store versions of the pickle backend do not fit in JavaScript numbers
+@app.route('/api/qc_events')
+def api_qc_events():
+    version, events = qc_events.changes_since(event_version())
+    response = jsonify({'version': None if version is None else str(version),
+                        'reload': events is None,
+                        'events': [json.loads(payload) for payload in events or []]})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 # Station page and associated plots
 @app.route('/station', methods=['GET', 'POST'])
 def soh_post():
-    stations = client.get_all_stations()
-    sta_tuplelist = []
-    for key, value in stations:
-        net_sta = key + '.' + value
-        sta_tuplelist.append((net_sta, net_sta))
+    sta_tuplelist = inventory.station_choices()
     form = StationForm()
     form.station.choices = sta_tuplelist
     global sta_id
@@ -271,55 +790,214 @@ def soh_post():
             sta_time = int(form.sta_days.data)
         else:
             sta_time = 0
-    return render_template('station.html', form=form)
+    # ?mode=client draws the SOH data in the browser instead of loading server-rendered images
+    client_mode = request.args.get('mode') == 'client'
+    return render_template('station.html', form=form, sta_id=sta_id, sta_time=sta_time, client_mode=client_mode)
 
 @app.route('/plot/soh/<sohid>')
 def plot_soh(sohid):
     if sta_time != 0:
         soh_id = sohid
-        fig, ax = soh_plot(sta_id, soh_id, sta_time)
-        if fig is None:
-            return ('', 204)
-        else:
-            response = fig2resp(fig)
+        soh_time, end_time = soh_window(sta_time)
+        key = soh_key(sta_id, soh_id, sta_time, end_time)
+        # The station comes from the page, not the URL, so browsers check the plot on every view
+        etag, mtime = soh_validators(key, end_time)
+        response = not_modified(etag, mtime)
+        if response is not None:
             return response
+        image = soh_cache.get(key)
+        if image is None:
+            traces = soh_plot_traces(sta_id, soh_id, soh_time, end_time)
+            if len(traces) == 0:
+                return ('', 204)
+            image = renders.run(key, render_soh_panel, sta_id, soh_id, traces, soh_time, end_time)
+            soh_cache.put(key, image)
+        return png_response(image, etag, mtime)
     else:
         return ('', 204)
 
+# All SOH channels of a station from one archive read
+# Returns one stacked image, or a JSON manifest of per-channel images with ?format=json
+@app.route('/plot/soh_all')
+def plot_soh_all():
+    sta = request.args.get('sta', sta_id)
+    days = request.args.get('days', sta_time, type=int)
+    if sta is None or days == 0:
+        return ('', 204)
+    if not STATION_pattern.match(sta):
+        return ('', 400)
+    soh_cache.record_use('%s/%d' % (sta, days))
+    fmt = request.args.get('format', 'png')
+    soh_time, end_time = soh_window(days)
+    etag, mtime = soh_validators(soh_key(sta, 'all-' + fmt, days, end_time), end_time)
+    # Without ?sta= the station comes from the page, so the URL alone does not identify the plot
+    max_age = http_max_age if 'sta' in request.args and 'days' in request.args else 0
+    response = not_modified(etag, mtime, max_age)
+    if response is not None:
+        return response
+    panels = soh_panels(sta, days)
+    if len(panels) == 0:
+        return ('', 204)
+    if fmt == 'json':
+        manifest = []
+        for soh_id, image in panels:
+            manifest.append({'channel': soh_id,
+                             'description': SOH_desc[soh_id],
+                             'image': 'data:image/png;base64,' + base64.b64encode(image).decode('ascii')})
+        return set_validators(jsonify({'station': sta, 'days': days, 'panels': manifest}), etag, mtime, max_age)
+    image = renders.run(soh_key(sta, 'stack', days, end_time), stack_png, [image for soh_id, image in panels])
+    return png_response(image, etag, mtime, max_age)
+
+# Values of a float array for JSON, NaN is not valid JSON and is sent as null
+def json_values(values, decimals=None):
+    return [None if np.isnan(v) else (round(float(v), decimals) if decimals is not None else float(v)) for v in values]
+
+# Decimated SOH time series of a station for drawing in the browser
+# ?format=json returns lists of epoch times and values, ?format=bin returns typed arrays (see pack_series)
+@app.route('/api/soh/<sta>')
+def api_soh(sta):
+    days = request.args.get('days', 7, type=int)
+    width = min(request.args.get('width', SOH_width, type=int), 4 * SOH_width)
+    fmt = request.args.get('format', 'json')
+    if days <= 0 or width <= 0 or fmt not in ['json', 'bin'] or not STATION_pattern.match(sta):
+        return ('', 400)
+    soh_time, end_time = soh_window(days)
+    key = soh_key(sta, 'api-%s-%d' % (fmt, width), days, end_time)
+    etag, mtime = soh_validators(key, end_time)
+    response = not_modified(etag, mtime, http_max_age)
+    if response is not None:
+        return response
+    payload = soh_cache.get(key)
+    if payload is None:
+        ns_id = sta.split(".")
+        st = get_soh_stream(ns_id[0], ns_id[1], soh_time, end_time)
+        series = soh_series(st, width)
+        series = {soh_id: series[soh_id] for soh_id in SOH_desc if soh_id in series}
+        header = {'station': sta,
+                  'start': UTCDateTime(soh_time).timestamp,
+                  'end': UTCDateTime(end_time).timestamp}
+        if fmt == 'bin':
+            payload = pack_series(header, series)
+        else:
+            channels = []
+            for soh_id, (times, data) in series.items():
+                channels.append({'channel': soh_id,
+                                 'description': SOH_desc[soh_id],
+                                 't': json_values(times, 3),
+                                 'v': json_values(data)})
+            payload = json.dumps(dict(header, channels=channels), separators=(',', ':')).encode('utf-8')
+        soh_cache.put(key, payload)
+    if fmt == 'bin':
+        return set_validators(compressed_response(payload, 'application/octet-stream'), etag, mtime, http_max_age)
+    return set_validators(compressed_response(payload, 'application/json'), etag, mtime, http_max_age)
+
+# Pixel columns per slot of the hourly and daily QC history tiers
+# Slots carry the min and max, so a few columns per slot still show every excursion
+QC_history_slot_pixels = 5
+
+# Trend of one QC parameter of every channel of a station over the last days
+# ?param= is a QC store column (default latency), ?days= (default 7), ?width= plot width in pixels (default SOH_width)
+# Short ranges return the values as received (t, v), longer ranges the hourly or daily mean, min and max
+@app.route('/api/qc_history/<sta>')
+def api_qc_history(sta):
+    param = request.args.get('param', 'latency')
+    days = request.args.get('days', 7, type=float)
+    width = min(request.args.get('width', SOH_width, type=int), 4 * SOH_width)
+    if param not in qc_store.QC_columns or days <= 0 or width <= 0:
+        return ('', 400)
+    end = time.time()
+    start = end - days * 86400
+    with metrics.span('qc_history_read'):
+        tier, series = QC_history.query(sta, param, start, end, max(width // QC_history_slot_pixels, 1))
+    channels = []
+    for nslc, arrays in series.items():
+        if tier == 'raw':
+            times, values = downsample(arrays['time'], arrays['value'], width)
+            channels.append({'nslc': nslc, 't': json_values(times, 3), 'v': json_values(values)})
+        else:
+            channels.append({'nslc': nslc,
+                             't': json_values(arrays['time']),
+                             'mean': json_values(arrays['mean']),
+                             'min': json_values(arrays['min']),
+                             'max': json_values(arrays['max']),
+                             'count': [int(count) for count in arrays['count']]})
+    return jsonify({'station': sta, 'param': param, 'tier': tier, 'start': start, 'end': end, 'channels': channels})
+
+# Start-up steps of the worker serving the request
+@app.route('/api/startup')
+def api_startup():
+    return jsonify(dict(startup_report(), pid=os.getpid()))
+
+# Hit and miss counts of the waveform cache of the worker serving the request
+@app.route('/api/waveform_cache')
+def api_waveform_cache():
+    return jsonify(dict(waveforms.stats(), pid=os.getpid()))
+
+# Timing spans and counters of all workers, render processes and the QC listener in the Prometheus format
+@app.route('/metrics')
+def prometheus_metrics():
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Parse a YYYY-MM-DD date from the page arguments, None if missing or invalid
+def arg_date(name):
+    try:
+        return datetime.strptime(request.args.get(name, ''), '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
 # PPSD page
+# The form posts the filters, the page links repeat them as arguments
 @app.route('/ppsd', methods=['GET', 'POST'])
 def ppsd_post():
-    stations = client.get_all_stations()
-    sta_tuplelist = []
-    for key, value in stations:
-        net_sta = key + '.' + value
-        sta_tuplelist.append((net_sta, net_sta))
+    sta_tuplelist = inventory.station_choices()
     form = PPSDForm()
     form.PPSDstation.choices = sta_tuplelist
     global staPPSD
     imagelist = []
+    pages = None
+    page = 1
     if form.validate_on_submit():
         staPPSD = form.PPSDstation.data
-        if staPPSD is not None:
-            imageList = []
-            PPSD_path = os.path.join(app_path,'static', 'ppsd')
-            for image in os.listdir(PPSD_path):
-                if image.startswith(staPPSD):
-                    imageList.append(image)
-            imageList.sort(key=lambda x: x[-12:-5])
-            imagelist = ['ppsd/' + image for image in imageList]
-    return render_template('ppsd.html', form=form, imagelist=imagelist)
+    elif request.method == 'GET' and request.args.get('sta'):
+        staPPSD = request.args.get('sta')
+        form.PPSDstation.data = staPPSD
+        form.PPSDsdate.data = arg_date('start')
+        form.PPSDedate.data = arg_date('end')
+        # Like the dates, a period that is not one of the form's choices falls back to the default (all)
+        period = request.args.get('period', '0')
+        form.PPSDperiod.data = period if period in dict(form.PPSDperiod.choices) else '0'
+        page = max(request.args.get('page', 1, type=int), 1)
+    else:
+        staPPSD = None
+    if staPPSD is not None:
+        start = form.PPSDsdate.data.strftime('%Y-%m-%d') if form.PPSDsdate.data else None
+        end = form.PPSDedate.data.strftime('%Y-%m-%d') if form.PPSDedate.data else None
+        period = int(form.PPSDperiod.data or 0)
+        conn = ppsd_catalog.connect(ppsd_catalog_path)
+        try:
+            ppsd_catalog.setup(conn)
+            with metrics.span('sqlite_query'):
+                total = ppsd_catalog.count(conn, staPPSD, start, end, period)
+                # A page past the end shows the last page
+                count = max((total + PPSD_page_size - 1) // PPSD_page_size, 1)
+                page = min(page, count)
+                rows = ppsd_catalog.query(conn, staPPSD, start, end, period, PPSD_page_size, (page - 1) * PPSD_page_size)
+        finally:
+            conn.close()
+        imagelist = [row[0] for row in rows]
+        pages = {'page': page,
+                 'count': count,
+                 'total': total,
+                 'args': {'sta': staPPSD, 'start': start or '', 'end': end or '', 'period': period}}
+    return render_template('ppsd.html', form=form, imagelist=imagelist, pages=pages)
 
 # Helicorder page
 @app.route('/heli', methods=['GET', 'POST'])
 def heli_post():
-    nslc_all = client.get_all_nslc(datetime=UTCDateTime.now())
-    nslc_tuplelist = []
-    for nslc_code in nslc_all:
-        net, sta, loc, chan = nslc_code
-        if chan.startswith('HN'):
-            nslc = net + '.' + sta + '.' + loc + '.' + chan
-            nslc_tuplelist.append((nslc, nslc))
+    nslc_tuplelist = inventory.channel_choices('HN')
     form = HeliForm()
     form.heli_channel.choices = nslc_tuplelist
     if request.method == 'POST':
@@ -343,41 +1021,47 @@ def plot_heli():
         edt_str = str(edate) + "T" + str(etime)
         sdt = UTCDateTime(sdt_str)
         edt = UTCDateTime(edt_str)
-        nslc_id = heli_channel.split(".")
-        st = client.get_waveforms(nslc_id[0], nslc_id[1], nslc_id[2], nslc_id[3], sdt, edt)
-        if len(st) > 0:
-            fig = st.plot(type="dayplot", interval=60, right_vertical_labels=False, vertical_scaling_range=5e3, one_tick_per_line=True, show_y_UTC_label=False)
-            response = fig2resp(fig)
+        if edt <= sdt:
+            return ('', 204)
+        net, sta, loc, cha = heli_channel.split('.')
+        digest, mtime = waveforms.version(net, sta, loc, cha, sdt, edt)
+        etag = make_etag('heli', heli_channel, sdt.timestamp, edt.timestamp, digest)
+        response = not_modified(etag, mtime)
+        if response is not None:
             return response
-        else:
+        tiles = heli_tiles(waveforms, heli_cache, heli_channel, sdt, edt)
+        if all(np.all(np.isnan(tile)) for hour, tile in tiles):
             return ('No data found', 204)
+        image = renders.run(('heli', heli_channel, sdt.timestamp, edt.timestamp, digest), render_heli, heli_channel, tiles)
+        return png_response(image, etag, mtime)
     else:
         return ('', 204)
 
+# Render the tiles of a helicorder to PNG bytes, runs in the render processes
+# The tiles are read by the web worker, so render processes never read the archive
+def render_heli(heli_channel, tiles):
+    with metrics.span('figure'):
+        fig = draw_heli(heli_channel, tiles)
+    return fig2png(fig)
+
 # Real-time page
 @app.route('/rt', methods=['GET', 'POST'])
 def rt_post():
-    nslc_all = client.get_all_nslc(datetime=UTCDateTime.now())
-    nslc_tuplelist = []
-    for nslc_code in nslc_all:
-        net, sta, loc, chan = nslc_code
-        if chan.startswith('HN'):
-            nslc = net + '.' + sta + '.' + loc + '.' + chan
-            nslc_tuplelist.append((nslc, nslc))
+    nslc_tuplelist = inventory.channel_choices('HN')
     form = RTForm()
     form.rt_channel.choices = nslc_tuplelist
     return render_template('rt.html', form=form)
 
 @app.route('/plot/rt', methods=['POST'])
 def plot_rt():
-    rt_channel = request.get_json()
+    rt_channel = request.get_json(silent=True)
     if rt_channel is not None:
-        now_str = UTCDateTime.now().strftime('%Y-%m-%d %H:%M:%S')
-        subprocess.run(['/opt/seiscomp/seiscomp/bin/scheli', 'capture', '--stream', rt_channel, '-o', '/opt/scqcweb/static/images/rt_temp.png', '--end-time', now_str])
-        #Line below should work, but doesn't
-        #image_path = url_for('static', filename='/images/rt_temp.png')
-        image_path = "static/images/rt_temp.png"
-        return jsonify({'image_url': f'/{image_path}?t={int(time.time())}'})
+        # Only channels of the form's list, so requests cannot read wildcards or create images of any name
+        if not isinstance(rt_channel, str) or rt_channel not in dict(inventory.channel_choices('HN')):
+            return ('', 400)
+        filename, mtime = rt_engine.image(rt_channel)
+        image_path = url_for('static', filename='images/rt/' + filename)
+        return jsonify({'image_url': f'{image_path}?t={int(mtime)}'})
     else:
         return ('', 204)
 
@@ -391,83 +1075,164 @@ def server_post():
             session['edate2'] = form.edate2.data
     return render_template('server.html', form=form)
 
+# Server plot panels as title: (y axis label, upper y limit), in plotting order
+SERVER_panels = {'Disk Usage': ('Percent (%)', 100),
+                 'CPU and Memory Usage': ('Percent (%)', 100),
+                 'CPU Load': ('Load', None),
+                 'Other': ('Value', None)}
+
+# Line colors of the standard statistics, other columns use the default color cycle
+SERVER_colors = {'root_disk_usage': 'r', 'var_disk_usage': 'g', 'data_disk_usage': 'b', 'opt_disk_usage': 'm', 'home_disk_usage': 'c',
+                 'cpu_percent': 'b', 'memory_percent': 'r',
+                 'load_avg_1min': 'r', 'load_avg_5min': 'g', 'load_avg_15min': 'b'}
+
+# Panel of a system_stats column, new mount points go to the disk panel and unknown metrics to the other panel
+def server_panel(column):
+    if column.endswith('_disk_usage'):
+        return 'Disk Usage'
+    if column in ['cpu_percent', 'memory_percent']:
+        return 'CPU and Memory Usage'
+    if column.startswith('load_avg_'):
+        return 'CPU Load'
+    return 'Other'
+
+# Legend label of a system_stats column
+def server_label(column):
+    if column == 'root_disk_usage':
+        return '/ (Root)'
+    if column.endswith('_disk_usage'):
+        return '/' + column[:-len('_disk_usage')].capitalize()
+    if column.startswith('load_avg_'):
+        return column[len('load_avg_'):].replace('min', '-min')
+    if column == 'cpu_percent':
+        return 'CPU'
+    if column == 'memory_percent':
+        return 'Memory'
+    return column
+
+# Plot one server statistic downsampled to the plot width
+def server_line(ax, date_nums, values, **kwargs):
+    x, y = downsample(date_nums, values, server_width)
+    ax.plot(x, y, **kwargs)
+    ax.xaxis_date()
+
 @app.route('/plot/server')
 def plot_server():
     sdate2 = session.get('sdate2')
     edate2 = session.get('edate2')
     edate2 = edate2.strftime("%Y-%m-%d %H:%M:%S")
     sdate2 = sdate2.strftime("%Y-%m-%d %H:%M:%S")
-    stats = read_stats(sdate2, edate2)
-    # Process data for plotting
-    if len(stats) > 0:
-        time_data = [stat[1] for stat in stats]
-        datetime_objects = [datetime.strptime(time, "%Y-%m-%d %H:%M:%S") for time in time_data]
-        cpu_usage = [stat[2] for stat in stats]
-        mem_usage = [stat[3] for stat in stats]
-        root_usage = [stat[4] for stat in stats]
-        var_usage = [stat[5] for stat in stats]
-        data_usage = [stat[6] for stat in stats]
-        opt_usage = [stat[7] for stat in stats]
-        home_usage = [stat[8] for stat in stats]
-        min1_usage = [stat[9] for stat in stats]
-        min5_usage = [stat[10] for stat in stats]
-        min15_usage = [stat[11] for stat in stats]
-        min_date = min(datetime_objects)
-        max_date = max(datetime_objects)
-        # Create a Matplotlib figure
-        fig, ax = plt.subplots(3, 1, figsize=(6, 10), layout="constrained", dpi=200)
-        ax[0].plot(datetime_objects, root_usage, linestyle='-', color='r', label='/ (Root)')
-        ax[0].plot(datetime_objects, var_usage, linestyle='-', color='g', label='/Var')
-        ax[0].plot(datetime_objects, data_usage, linestyle='-', color='b', label='/Data')
-        ax[0].plot(datetime_objects, opt_usage, linestyle='-', color='m', label='/Opt')
-        ax[0].plot(datetime_objects, home_usage, linestyle='-', color='c', label='/Home')
-        ax[0].set_title('Disk Usage')
-        ax[0].set_ylabel('Percent (%)', fontsize=10)
-        ax[0].legend(loc='upper center', bbox_to_anchor=(0.5, -0.35), ncol=3)
-        ax[0].grid(True, which='major', axis='y')
-        ax[0].set_ylim(0, 100)
-        ax[0].set_xlim(min_date, max_date)
-        ax[0].tick_params(axis='x', labelrotation=45)
-        ax[0].tick_params(axis='both', labelsize=8)
-        ax[0].xaxis.set_major_formatter(DateFormatter('%b %d %H:%M'))
-        ax[1].plot(datetime_objects, cpu_usage, linestyle='-', color='b', label='CPU')
-        ax[1].plot(datetime_objects, mem_usage, linestyle='-', color='r', label='Memory')
-        ax[1].set_title('CPU and Memory Usage')
-        ax[1].set_ylabel('Percent (%)', fontsize=10)
-        ax[1].legend(loc='upper center', bbox_to_anchor=(0.5, -0.35), ncol=3)
-        ax[1].grid(True, which='major', axis='y')
-        ax[1].set_ylim(0, 100)
-        ax[1].set_xlim(min_date, max_date)
-        ax[1].tick_params(axis='x', labelrotation=45)
-        ax[1].tick_params(axis='both', labelsize=8)
-        ax[1].xaxis.set_major_formatter(DateFormatter('%b %d %H:%M'))
-        ax[2].plot(datetime_objects, min1_usage, linestyle='-', color='r', label='1-min')
-        ax[2].plot(datetime_objects, min5_usage, linestyle='-', color='g', label='5-min')
-        ax[2].plot(datetime_objects, min15_usage, linestyle='-', color='b', label='15-min')
-        ax[2].set_title('CPU Load')
-        ax[2].set_ylabel('Load', fontsize=10)
-        ax[2].legend(loc='upper center', bbox_to_anchor=(0.5, -0.35), ncol=3)
-        ax[2].grid(True, which='major', axis='y')
-        ax[2].set_ylim(bottom=0)
-        ax[2].set_xlim(min_date, max_date)
-        ax[2].tick_params(axis='x', labelrotation=45)
-        ax[2].tick_params(axis='both', labelsize=8)
-        ax[2].xaxis.set_major_formatter(DateFormatter('%b %d %H:%M'))
-        if len(datetime_objects) < 7200:
-            ax[0].xaxis.set_major_locator(HourLocator(interval=4))
-            ax[1].xaxis.set_major_locator(HourLocator(interval=4))
-            ax[2].xaxis.set_major_locator(HourLocator(interval=4))
-        else:
-            ax[0].xaxis.set_major_locator(DayLocator(interval=5))
-            ax[1].xaxis.set_major_locator(DayLocator(interval=5))
-            ax[2].xaxis.set_major_locator(DayLocator(interval=5))
-        fig.get_layout_engine().set(hspace=0.1)
-        
-        # Return the figure as a response
-        response = fig2resp(fig)
+    conn = sqlite3.connect(systemdb_path)
+    try:
+        with metrics.span('sqlite_query'):
+            oldest, newest = stats_db.version(conn, edate2)
+    finally:
+        conn.close()
+    etag = make_etag('server', sdate2, edate2, oldest, newest)
+    mtime = datetime.strptime(newest, stats_db.TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp() if newest else None
+    response = not_modified(etag, mtime)
+    if response is not None:
         return response
-    else:
+    times, stats = read_stats(sdate2, edate2)
+    if len(times) == 0:
         return ('No data found', 204)
+    image = renders.run(('server', sdate2, edate2, newest), render_server, times, stats)
+    return png_response(image, etag, mtime)
+
+# Render the server statistics to PNG bytes, runs in the render processes
+def render_server(times, stats):
+    with metrics.span('figure'):
+        fig = draw_server(times, stats)
+    return fig2png(fig)
+
+# Draw the server statistics into a new matplotlib figure
+def draw_server(times, stats):
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import date2num, DateFormatter, DayLocator, HourLocator
+    # Group the columns that have data into panels
+    panels = collections.OrderedDict((title, []) for title in SERVER_panels)
+    for column, values in stats.items():
+        if not np.all(np.isnan(values)):
+            panels[server_panel(column)].append(column)
+    panels = [(title, columns) for title, columns in panels.items() if columns]
+    min_date = times[0].astype(datetime)
+    max_date = times[-1].astype(datetime)
+    date_nums = date2num(times)
+    # Create a Matplotlib figure
+    fig, ax = plt.subplots(len(panels), 1, figsize=(6, 10 * len(panels) / 3.0), layout="constrained", dpi=200, squeeze=False)
+    for i, (title, columns) in enumerate(panels):
+        ylabel, ymax = SERVER_panels[title]
+        for column in columns:
+            kwargs = {'color': SERVER_colors[column]} if column in SERVER_colors else {}
+            server_line(ax[i, 0], date_nums, stats[column], linestyle='-', label=server_label(column), **kwargs)
+        ax[i, 0].set_title(title)
+        ax[i, 0].set_ylabel(ylabel, fontsize=10)
+        ax[i, 0].legend(loc='upper center', bbox_to_anchor=(0.5, -0.35), ncol=3)
+        ax[i, 0].grid(True, which='major', axis='y')
+        ax[i, 0].set_ylim(bottom=0, top=ymax)
+        ax[i, 0].set_xlim(min_date, max_date)
+        ax[i, 0].tick_params(axis='x', labelrotation=45)
+        ax[i, 0].tick_params(axis='both', labelsize=8)
+        ax[i, 0].xaxis.set_major_formatter(DateFormatter('%b %d %H:%M'))
+        # Rollups change the number of rows, so pick the tick spacing from the time span
+        if max_date - min_date < timedelta(days=5):
+            ax[i, 0].xaxis.set_major_locator(HourLocator(interval=4))
+        else:
+            ax[i, 0].xaxis.set_major_locator(DayLocator(interval=5))
+    fig.get_layout_engine().set(hspace=0.1)
+    return fig
+
+# Load what the workers share before gunicorn forks them (GUNICORN_PRELOAD=1, see gunicorn_config.py)
+# Modules and state loaded here are shared copy-on-write by the workers instead of loaded by each of them
+def preload():
+    global preloaded
+    with startup_step('preload matplotlib'):
+        import matplotlib.pyplot
+    with startup_step('preload inventory index'):
+        inventory.preload()
+    with startup_step('preload network table'):
+        try:
+            network_table()
+        except Exception as error:
+            app.logger.error("Failed to preload network table: %s", error)
+    # Keep the collector of the workers from touching, and so copying, the preloaded objects
+    gc.freeze()
+    preloaded = True
+    print_startup()
+
+preloaded = False
+
+# Seconds of each start-up step, and whether the module was loaded before the worker was forked
+def startup_report():
+    steps = collections.OrderedDict((name, round(seconds, 4)) for name, seconds in startup.items())
+    return {'steps': steps, 'total': round(sum(startup.values()), 4), 'preloaded': preloaded}
+
+def print_startup():
+    report = startup_report()
+    steps = ', '.join('%s %.2f s' % (name, seconds) for name, seconds in report['steps'].items())
+    print("scqcweb loaded in %.2f s (%s)" % (report['total'], steps), file=sys.stderr, flush=True)
+
+# Render jobs that are queued too long or time out leave the request to be retried
+@app.errorhandler(RenderError)
+def render_error(error):
+    return (str(error), 503, {'Retry-After': '10'})
+
+# Pre-render the most used SOH station views for the current UTC day
+# Run from cron shortly after midnight UTC: flask --app scqcweb warm-soh-cache
+@app.cli.command('warm-soh-cache')
+@click.option('--count', default=50, help='Number of station views to pre-render.')
+@click.option('--max-age', default=7, help='Only consider views used within this many days.')
+def warm_soh_cache(count, max_age):
+    for name in soh_cache.most_used(count, max_age * 86400):
+        sta, days = name.rsplit('/', 1)
+        try:
+            panels = soh_panels(sta, int(days))
+            print("Pre-rendered %d SOH panels for %s over %s days" % (len(panels), sta, days))
+        except Exception as error:
+            print("Failed to pre-render SOH panels for {0}: {1}".format(sta, str(error)))
+
+startup['state'] = time.perf_counter() - startup_start - startup['imports'] - startup['config']
 
 if __name__ == "__main__":
+    print_startup()
     app.run(host='0.0.0.0', port=8000, debug=False)
\ No newline at end of file
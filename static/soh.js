@@ -0,0 +1,178 @@
+// Draws SOH time series from /api/soh in the browser
+// Drag across a panel to zoom all panels in time, double-click to reset
+
+const SOH_SCATTER = ['rmz', 'rmn', 'rm2', 'rme', 'rm1', 'mxz', 'mxn', 'mx2', 'mxe', 'mx1'];
+const SOH_PERCENT = ['dsk', 'lcq'];
+const MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'];
+
+// Parse the binary payload of /api/soh (see pack_series in scqcweb.py)
+function parseSOH(buffer) {
+    const headerLength = new DataView(buffer).getUint32(0, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+    const base = 4 + headerLength;
+    for (const channel of header.channels) {
+        channel.t = new Float64Array(buffer, base + channel.offset, channel.n);
+        channel.v = new Float32Array(buffer, base + channel.offset + 8 * channel.n, channel.n);
+    }
+    return header;
+}
+
+function formatDate(t, span) {
+    const d = new Date(t * 1000);
+    const day = MONTHS[d.getUTCMonth()] + ' ' + String(d.getUTCDate()).padStart(2, '0');
+    if (span > 3 * 86400) {
+        return day + ' ' + d.getUTCFullYear();
+    }
+    return day + ' ' + String(d.getUTCHours()).padStart(2, '0') + ':' + String(d.getUTCMinutes()).padStart(2, '0');
+}
+
+function niceStep(range, count) {
+    const raw = range / count;
+    const power = Math.pow(10, Math.floor(Math.log10(raw)));
+    for (const m of [1, 2, 5, 10]) {
+        if (raw <= m * power) {
+            return m * power;
+        }
+    }
+    return 10 * power;
+}
+
+function drawPanel(panel, tmin, tmax) {
+    const canvas = panel.canvas;
+    const ctx = canvas.getContext('2d');
+    const ch = panel.channel;
+    const left = 70, right = 20, top = 30, bottom = 30;
+    const w = canvas.width - left - right;
+    const h = canvas.height - top - bottom;
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+    let vmin = Infinity, vmax = -Infinity;
+    for (let i = 0; i < ch.n; i++) {
+        const t = ch.t[i], v = ch.v[i];
+        if (t >= tmin && t <= tmax && !Number.isNaN(v)) {
+            vmin = Math.min(vmin, v);
+            vmax = Math.max(vmax, v);
+        }
+    }
+    if (SOH_PERCENT.includes(ch.channel)) {
+        vmin = 0;
+        vmax = 105;
+    }
+    if (!Number.isFinite(vmin)) {
+        vmin = 0;
+        vmax = 1;
+    }
+    if (vmin === vmax) {
+        vmin -= 1;
+        vmax += 1;
+    }
+    const x = t => left + (t - tmin) / (tmax - tmin) * w;
+    const y = v => top + h - (v - vmin) / (vmax - vmin) * h;
+
+    // Grid, ticks and labels
+    ctx.strokeStyle = '#b0b0b0';
+    ctx.fillStyle = 'black';
+    ctx.font = '12px Arial';
+    ctx.lineWidth = 1;
+    ctx.textAlign = 'right';
+    const vstep = niceStep(vmax - vmin, 4);
+    for (let v = Math.ceil(vmin / vstep) * vstep; v <= vmax; v += vstep) {
+        ctx.beginPath();
+        ctx.moveTo(left, y(v));
+        ctx.lineTo(left + w, y(v));
+        ctx.stroke();
+        ctx.fillText(Number(v.toPrecision(6)), left - 5, y(v) + 4);
+    }
+    ctx.textAlign = 'center';
+    const tstep = Math.max(3600, Math.ceil(niceStep(tmax - tmin, 5) / 3600) * 3600);
+    for (let t = Math.ceil(tmin / tstep) * tstep; t <= tmax; t += tstep) {
+        ctx.beginPath();
+        ctx.moveTo(x(t), top);
+        ctx.lineTo(x(t), top + h);
+        ctx.stroke();
+        ctx.fillText(formatDate(t, tmax - tmin), x(t), top + h + 18);
+    }
+    ctx.font = '16px Arial';
+    ctx.fillText(ch.description + ' - ' + panel.station, left + w / 2, 20);
+    ctx.strokeStyle = 'black';
+    ctx.strokeRect(left, top, w, h);
+
+    // Data
+    ctx.save();
+    ctx.beginPath();
+    ctx.rect(left, top, w, h);
+    ctx.clip();
+    ctx.strokeStyle = 'green';
+    ctx.fillStyle = 'green';
+    if (SOH_SCATTER.includes(ch.channel)) {
+        for (let i = 0; i < ch.n; i++) {
+            if (!Number.isNaN(ch.v[i])) {
+                ctx.fillRect(x(ch.t[i]) - 1, y(ch.v[i]) - 1, 3, 3);
+            }
+        }
+    } else {
+        ctx.beginPath();
+        let pen = false;
+        for (let i = 0; i < ch.n; i++) {
+            if (Number.isNaN(ch.v[i]) || Number.isNaN(ch.t[i])) {
+                pen = false;
+            } else if (pen) {
+                ctx.lineTo(x(ch.t[i]), y(ch.v[i]));
+            } else {
+                ctx.moveTo(x(ch.t[i]), y(ch.v[i]));
+                pen = true;
+            }
+        }
+        ctx.stroke();
+    }
+    ctx.restore();
+}
+
+function loadSOH(container) {
+    const url = container.dataset.url;
+    fetch(url)
+        .then(response => response.arrayBuffer())
+        .then(buffer => {
+            const data = parseSOH(buffer);
+            const panels = [];
+            let view = [data.start, data.end];
+            const redraw = () => panels.forEach(panel => drawPanel(panel, view[0], view[1]));
+            for (const channel of data.channels) {
+                const canvas = document.createElement('canvas');
+                canvas.width = 1000;
+                canvas.height = 300;
+                canvas.className = 'center';
+                container.appendChild(canvas);
+                const panel = {canvas: canvas, channel: channel, station: data.station};
+                panels.push(panel);
+                let dragStart = null;
+                const toTime = event => {
+                    const rect = canvas.getBoundingClientRect();
+                    const px = (event.clientX - rect.left) / rect.width * canvas.width;
+                    return view[0] + (px - 70) / (canvas.width - 90) * (view[1] - view[0]);
+                };
+                canvas.addEventListener('mousedown', event => { dragStart = toTime(event); });
+                canvas.addEventListener('mouseup', event => {
+                    const dragEnd = toTime(event);
+                    if (dragStart !== null && Math.abs(dragEnd - dragStart) > 60) {
+                        view = [Math.min(dragStart, dragEnd), Math.max(dragStart, dragEnd)];
+                        redraw();
+                    }
+                    dragStart = null;
+                });
+                canvas.addEventListener('dblclick', () => {
+                    view = [data.start, data.end];
+                    redraw();
+                });
+            }
+            redraw();
+        })
+        .catch(error => console.error('Error fetching SOH data:', error));
+}
+
+window.addEventListener('load', () => {
+    const container = document.getElementById('soh-panels');
+    if (container) {
+        loadSOH(container);
+    }
+});
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of listeners/response_cache.py: CachedPPSD gives the same PSDs as PPSD
+without running evalresp once the response curves are cached.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core.inventory import Channel, Inventory, Network, Response, Site, Station
+from obspy.signal import PPSD
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'listeners'))
+
+from response_cache import CachedPPSD, ResponseCache
+
+def make_inventory(xml_path, rate, start_date=UTCDateTime(2000, 1, 1)):
+    response = Response.from_paz(zeros=[], poles=[], stage_gain=4e5, stage_gain_frequency=1.0,
+                                 input_units='M/S**2', output_units='COUNTS')
+    channel = Channel('HNZ', '00', latitude=0.0, longitude=0.0, elevation=0.0, depth=0.0,
+                      sample_rate=rate, start_date=start_date, response=response)
+    station = Station('S000', latitude=0.0, longitude=0.0, elevation=0.0, channels=[channel],
+                      site=Site(name='S000'), start_date=UTCDateTime(2000, 1, 1))
+    Inventory(networks=[Network('XX', stations=[station])], source='test').write(xml_path, format='STATIONXML')
+
+def make_stream(rate, hours):
+    data = np.random.default_rng(0).normal(0, 500, int(hours * 3600 * rate)).astype(np.int32)
+    return Stream([Trace(data=data, header={'network': 'XX', 'station': 'S000', 'location': '00', 'channel': 'HNZ',
+                                            'sampling_rate': rate, 'starttime': UTCDateTime(2024, 1, 1)})])
+
+class CachedPPSDTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rate = 20.0
+        self.xml_path = os.path.join(self.tmp.name, 'XX_S000.xml')
+        make_inventory(self.xml_path, self.rate)
+        self.cache = ResponseCache(os.path.join(self.tmp.name, 'cache'))
+        self.inv = self.cache.inventory(self.xml_path)
+        self.st = make_stream(self.rate, 3)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_no_evalresp_per_segment(self):
+        expected = PPSD(self.st[0].stats, metadata=self.inv)
+        expected.add(self.st)
+        ppsd = CachedPPSD(self.st[0].stats, metadata=self.inv)
+        # Evaluates and caches the curves
+        ppsd.use_responses(self.cache, self.xml_path, self.inv)
+        with mock.patch.object(Response, 'get_evalresp_response', side_effect=AssertionError('evalresp called')) as evalresp:
+            self.assertTrue(ppsd.add(self.st))
+            # A PPSD loaded from npz reads the curves from the cache file
+            npz_path = os.path.join(self.tmp.name, 'ppsd.npz')
+            ppsd.save_npz(npz_path)
+            loaded = CachedPPSD.load_npz(npz_path)
+            loaded.use_responses(self.cache, self.xml_path, self.inv)
+            self.assertIsInstance(loaded, CachedPPSD)
+            self.assertFalse(loaded.add(self.st))
+        evalresp.assert_not_called()
+        self.assertGreater(len(ppsd.times_processed), 1)
+        self.assertEqual(ppsd.times_processed, expected.times_processed)
+        np.testing.assert_allclose(np.array(ppsd.psd_values), np.array(expected.psd_values))
+
+    def test_fallback_outside_epochs(self):
+        ppsd = CachedPPSD(self.st[0].stats, metadata=self.inv)
+        ppsd.use_responses(self.cache, self.xml_path, self.inv)
+        ppsd.response_epochs = []
+        self.assertTrue(ppsd.add(self.st))
+
+    def test_open_start_date(self):
+        xml_path = os.path.join(self.tmp.name, 'XX_S000_open.xml')
+        make_inventory(xml_path, self.rate, start_date=None)
+        inv = self.cache.inventory(xml_path)
+        self.assertIsNone(inv[0][0][0].start_date)
+        ppsd = CachedPPSD(self.st[0].stats, metadata=inv)
+        ppsd.use_responses(self.cache, xml_path, inv)
+        self.assertEqual(ppsd.response_epochs[0]['start_time'], UTCDateTime(1900, 1, 1))
+        self.assertTrue(ppsd.add(self.st))
+
+if __name__ == '__main__':
+    unittest.main()
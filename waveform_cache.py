@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of decoded SDS day files shared by the SOH, helicorder and real-time views
+
+Wraps a waveform client with the same get_waveforms call. Each archive day file
+(one NSLC and day) is decoded from miniSEED once and kept until the file's
+modification time or size changes. Decoded files are kept either in the memory
+of each worker, or as .npy files in a shared memory folder (e.g. /dev/shm) that
+all workers map instead of holding their own copy. Least recently used files
+are evicted above the byte budget. Files still being written (changed within
+the last hot_seconds, e.g. the current day) are read directly for the requested
+window and not cached. Hits and misses are counted for stats().
+"""
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime, read
+from obspy.io.mseed import ObsPyMSEEDFilesizeTooSmallError
+
+from listeners import metrics
+
+class WaveformCache:
+    # client is an SDS client, or a client with an sds attribute and an update method that fills it (CachedFDSNClient)
+    def __init__(self, client, max_bytes, shm_dir=None, hot_seconds=300):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.shm_dir = shm_dir
+        self.hot_seconds = hot_seconds
+        self.files = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0, 'bypassed': 0}
+        if shm_dir:
+            os.makedirs(shm_dir, exist_ok=True)
+
+    def sds(self):
+        return getattr(self.client, 'sds', self.client)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    # Archive files holding the requested data, per channel of a comma separated list
+    def filenames(self, network, station, location, channel, starttime, endtime):
+        if hasattr(self.client, 'update'):
+            self.client.update(network, station, location, channel, starttime, endtime)
+        sds = self.sds()
+        return [(cha, sorted(sds._get_filenames(network, station, location, cha, starttime, endtime))) for cha in channel.split(',')]
+
+    # Version of the requested data from the names, modification times and sizes of its files, without reading them
+    # Returns a digest and the latest modification time (None if there are no files)
+    def version(self, network, station, location, channel, starttime, endtime):
+        digest = hashlib.sha1()
+        latest = None
+        with metrics.span('archive_stat'):
+            for cha, paths in self.filenames(network, station, location, channel, starttime, endtime):
+                for path in paths:
+                    try:
+                        info = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    digest.update(('%s %d %d\n' % (path, info.st_mtime_ns, info.st_size)).encode('utf-8'))
+                    latest = max(latest or 0, info.st_mtime)
+        return digest.hexdigest(), latest
+
+    # Same arguments as the SDS client, channel may be a comma separated list
+    def get_waveforms(self, network, station, location, channel, starttime, endtime):
+        with metrics.span('archive_read'):
+            return self.read_waveforms(network, station, location, channel, starttime, endtime)
+
+    def read_waveforms(self, network, station, location, channel, starttime, endtime):
+        st = Stream()
+        for cha, paths in self.filenames(network, station, location, channel, starttime, endtime):
+            part = Stream()
+            for path in paths:
+                for tr in self.read_file(path, starttime, endtime):
+                    if tr.stats.endtime >= starttime and tr.stats.starttime <= endtime:
+                        # Slices share the cached data, the cached traces themselves are never changed
+                        part.append(tr.slice(starttime, endtime))
+            st += part.select(network=network, station=station, location=location, channel=cha)
+        # Same cleanup merge as the SDS client, joining traces across day files
+        st.merge(-1)
+        return st
+
+    # Decoded traces of one archive file, decoding it only if it is not cached or changed
+    def read_file(self, path, starttime, endtime):
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return []
+        if time.time() - info.st_mtime < self.hot_seconds:
+            self.count('bypassed')
+            try:
+                return list(read(path, format='MSEED', starttime=starttime, endtime=endtime))
+            except ObsPyMSEEDFilesizeTooSmallError:
+                return []
+        signature = [info.st_mtime_ns, info.st_size]
+        if self.shm_dir:
+            traces = self.read_shm(path, signature)
+        else:
+            with self.lock:
+                entry = self.files.get(path)
+                if entry is not None and entry[0] == signature:
+                    self.files.move_to_end(path)
+                    self.counts['hits'] += 1
+                    return entry[1]
+                if entry is not None:
+                    self.counts['invalidations'] += 1
+            traces = None
+        if traces is not None:
+            self.count('hits')
+            return traces
+        self.count('misses')
+        try:
+            traces = list(read(path, format='MSEED'))
+        except ObsPyMSEEDFilesizeTooSmallError:
+            # Files are sometimes read right after they were created
+            return []
+        for tr in traces:
+            tr.data.flags.writeable = False
+        if self.shm_dir:
+            self.write_shm(path, signature, traces)
+        else:
+            self.put(path, signature, traces)
+        return traces
+
+    def put(self, path, signature, traces):
+        nbytes = sum(tr.data.nbytes for tr in traces)
+        with self.lock:
+            old = self.files.pop(path, None)
+            if old is not None:
+                self.size -= old[2]
+            self.files[path] = (signature, traces, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self.files) > 1:
+                old_path, old = self.files.popitem(last=False)
+                self.size -= old[2]
+                self.counts['evictions'] += 1
+
+    def shm_key(self, path):
+        return os.path.join(self.shm_dir, hashlib.sha1(path.encode('utf-8')).hexdigest())
+
+    # Map the traces of a file from the shared memory folder, None if they are missing or out of date
+    def read_shm(self, path, signature):
+        key = self.shm_key(path)
+        try:
+            with open(key + '.json') as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if meta['signature'] != signature:
+            self.count('invalidations')
+            return None
+        traces = []
+        try:
+            for i, stats in enumerate(meta['traces']):
+                data = np.load('%s.%d.npy' % (key, i), mmap_mode='r')
+                tr = Trace(data=data, header={'network': stats['network'], 'station': stats['station'],
+                                              'location': stats['location'], 'channel': stats['channel'],
+                                              'starttime': UTCDateTime(ns=stats['starttime']),
+                                              'sampling_rate': stats['sampling_rate'], 'calib': stats['calib']})
+                traces.append(tr)
+        except (FileNotFoundError, ValueError):
+            # Evicted by another worker while reading
+            return None
+        # The access time of the description file orders the eviction
+        try:
+            os.utime(key + '.json')
+        except FileNotFoundError:
+            pass
+        return traces
+
+    # Store the traces of a file in the shared memory folder, the description file is written last
+    def write_shm(self, path, signature, traces):
+        key = self.shm_key(path)
+        for i, tr in enumerate(traces):
+            self.write_atomic('%s.%d.npy' % (key, i), lambda f, data=tr.data: np.save(f, np.ascontiguousarray(data)))
+        meta = {'path': path, 'signature': signature,
+                'traces': [{'network': tr.stats.network, 'station': tr.stats.station,
+                            'location': tr.stats.location, 'channel': tr.stats.channel,
+                            'starttime': tr.stats.starttime.ns, 'sampling_rate': tr.stats.sampling_rate,
+                            'calib': tr.stats.calib} for tr in traces]}
+        self.write_atomic(key + '.json', lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        self.evict_shm()
+
+    def write_atomic(self, path, write):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp.', dir=self.shm_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    # Remove the least recently used files from the shared memory folder above the byte budget
+    def evict_shm(self):
+        entries = []
+        total = 0
+        for meta_path in glob.glob(os.path.join(self.shm_dir, '*.json')):
+            key = meta_path[:-len('.json')]
+            try:
+                size = sum(os.path.getsize(npy) for npy in glob.glob(key + '.*.npy'))
+                entries.append((os.path.getmtime(meta_path), key, size))
+            except FileNotFoundError:
+                continue
+            total += size
+        for mtime, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for name in [key + '.json'] + glob.glob(key + '.*.npy'):
+                try:
+                    os.unlink(name)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self.count('evictions')
+
+    # Hit and miss counts of this worker, and the bytes held by the cache
+    def stats(self):
+        with self.lock:
+            result = dict(self.counts)
+            result['files'] = len(self.files)
+            result['bytes'] = self.size
+        if self.shm_dir:
+            result['files'] = len(glob.glob(os.path.join(self.shm_dir, '*.json')))
+            result['bytes'] = sum(os.path.getsize(npy) for npy in glob.glob(os.path.join(self.shm_dir, '*.npy')))
+        requests = result['hits'] + result['misses'] + result['bypassed']
+        result['hit_rate'] = result['hits'] / float(requests) if requests else None
+        result['max_bytes'] = self.max_bytes
+        result['shared'] = bool(self.shm_dir)
+        return result